@@ -1,25 +1,206 @@
 import os
-from flask import Flask, render_template, request, redirect, url_for, jsonify
-from werkzeug.utils import secure_filename
+import calendar
+from collections import defaultdict
+import click
+from flask import Flask, Response, render_template, request, redirect, url_for, jsonify, abort, stream_with_context, session, g
+from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, date, timedelta
-from models import db, RoutineItem, TrackerLog, DiaryEntry, Reminder, DiaryImage, UserSetting
+from urllib.parse import urlsplit
+from sqlalchemy import func, case, tuple_, update
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import selectinload, contains_eager
+from models import (db, RoutineItem, TrackerLog, DiaryEntry, Reminder, DiaryImage, UserSetting, RoutineRollup, DiaryRollup, User,
+                    CompletionBitmap, parse_minute, format_minute)
+import rollups
+import migrations
+import thumbnails
+import search
+import schedule
+import metrics
+import database
+import backup
+import streaks
+import versions
+import photostore
+import shards
+import reminders
+import live
+import bitmaps
+import entries
+import archive
 
 app = Flask(__name__)
-app.config['SECRET_KEY'] = 'dev-key-change-this'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///habit_tracker.db'
+app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY') or 'dev-key-change-this' # Signs session cookies; set it for SHARDING
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///habit_tracker.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['UPLOAD_FOLDER'] = os.path.join(app.root_path, 'static', 'uploads')
+app.config['UPLOAD_STAGING_FOLDER'] = os.path.join(app.instance_path, 'upload-staging') # Uploads stream in here; keep it on the same filesystem as UPLOAD_FOLDER
+app.config['THUMBNAIL_WORKERS'] = 2 # Processes rendering photo thumbnails in the background
+app.config['MAX_PHOTO_SIZE'] = 25 * 1024 * 1024 # Larger uploads are rejected with 413 while they stream in
+app.config['NPLUSONE_THRESHOLD'] = 10 # Log requests that run one statement shape more often than this
+app.config['SERVER_TIMING'] = os.environ.get('SERVER_TIMING') == '1' # Send per-request app/db timings to the browser
+app.config['SQLITE_TUNING'] = os.environ.get('SQLITE_TUNING') != '0' # WAL, pragmas, pooling and write retries (see database.py)
+app.config['PAGE_CACHE_SIZE'] = 32 # Rendered read-only pages kept per process, keyed by data version; 0 disables
+app.config['SHARDING'] = os.environ.get('SHARDING') == '1' # One database per user, with sign-in (see shards.py)
+app.config['REMINDER_SCHEDULER'] = os.environ.get('REMINDER_SCHEDULER') != '0' # Deliver timed reminders from this process (see reminders.py)
+app.config['LIVE_UPDATES'] = os.environ.get('LIVE_UPDATES') != '0' # Stream changes to other open pages on LIVE_PORT (see live.py)
+
+# Sign-ins trust the session cookie's user id, so its key must not be the public default
+if app.config['SHARDING'] and not os.environ.get('SECRET_KEY'):
+    raise RuntimeError("SHARDING=1 needs a SECRET_KEY environment variable to sign session cookies.")
 
 # Ensure upload directory exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
+database.init_app(app)
+shards.init_app(app)
 db.init_app(app)
+metrics.init_app(app)
+reminders.init_app(app)
+live.init_app(app)
+app.request_class = photostore.UploadRequest
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def save_photos(files, entry_id):
+    """Store uploads by content hash and attach them to an entry; returns the new DiaryImage rows.
+
+    Called after the entry upsert, so the files are stored under the write lock (see photostore.py).
+    """
+    images = []
+    for file in files:
+        if file and allowed_file(file.filename):
+            filename = file.stream.store(file.filename.rsplit('.', 1)[1].lower())
+            images.append(DiaryImage(diary_entry_id=entry_id, image_path=filename))
+    db.session.add_all(images)
+    return images
+
+def upsert_diary_entry(entry_date, **values):
+    """Create or update the entry for a day in one statement, returning its id"""
+    stmt = insert(DiaryEntry).values(date=entry_date, version=1 if values else 0, **values)
+    set_ = {k: stmt.excluded[k] for k in values}
+    if set_:
+        set_['version'] = DiaryEntry.version + 1
+    else:
+        # With no values to write, a no-op update still lets RETURNING yield the id
+        set_ = {'date': stmt.excluded.date}
+    stmt = stmt.on_conflict_do_update(index_elements=['date'], set_=set_)
+    return db.session.execute(stmt.returning(DiaryEntry.id)).scalar_one()
+
+def apply_patch(text, patch):
+    """Apply a {start, end, text} splice to text.
+
+    Offsets count UTF-16 code units, the way the browser's string indices do.
+    Raises ValueError if the splice doesn't fit the text.
+    """
+    units = text.encode('utf-16-le', 'surrogatepass')
+    start, end = int(patch['start']), int(patch['end'])
+    if not 0 <= start <= end <= len(units) // 2:
+        raise ValueError('patch out of range')
+    replacement = str(patch.get('text', '')).encode('utf-16-le', 'surrogatepass')
+    return (units[:start * 2] + replacement + units[end * 2:]).decode('utf-16-le')
+
+# Reachable without signing in when SHARDING is on
+PUBLIC_ENDPOINTS = {'login', 'static', 'metrics_endpoint'}
+
+@app.before_request
+def load_user():
+    """With SHARDING on, point the request at the signed-in user's database"""
+    g.user = None
+    if not app.config['SHARDING'] or request.endpoint in PUBLIC_ENDPOINTS:
+        return
+    user_id = session.get('user_id')
+    g.user = db.session.get(User, user_id) if user_id else None
+    if g.user is None:
+        if request.path.startswith('/api/') or request.is_json:
+            return jsonify({'success': False, 'error': 'Sign in required'}), 401
+        return redirect(url_for('login', next=request.full_path))
+    shards.activate(g.user.shard)
+
+def is_local_path(url):
+    """True for a path on this site; browsers read a backslash as a slash, so `/\\host` leaves it"""
+    if not url.startswith('/') or url.startswith('//'):
+        return False
+    if '\\' in url or any(ord(c) < 32 or ord(c) == 127 for c in url):
+        return False
+    parts = urlsplit(url)
+    return not parts.scheme and not parts.netloc
+
+@app.route('/login', methods=['GET', 'POST'])
+def login():
+    error = None
+    if request.method == 'POST':
+        user = User.query.filter_by(username=request.form.get('username', '').strip()).first()
+        if user and check_password_hash(user.password_hash, request.form.get('password', '')):
+            session.clear()
+            session['user_id'] = user.id
+            next_url = request.args.get('next', '')
+            # Only follow local paths, never another site
+            return redirect(next_url if is_local_path(next_url) else url_for('dashboard'))
+        error = 'Wrong username or password.'
+    return render_template('login.html', error=error)
+
+@app.route('/logout', methods=['POST'])
+def logout():
+    session.clear()
+    return redirect(url_for('login'))
+
+def completion_score(completed, total):
+    return int((completed / total * 100)) if total > 0 else 0
+
+def day_score(current_date):
+    """The dashboard's score for a day, without building the rest of its state"""
+    total = len(schedule.get_schedule(schedule.routine_type_for(current_date)))
+    completed = sum(1 for status in archive.day_statuses(current_date).values() if status)
+    return completion_score(completed, total)
+
+def publish_habits(target_date, statuses, client=None):
+    """Tell other open dashboards about new {item_id: status} values for a day"""
+    if live.active():
+        live.publish('habits', {
+            'date': target_date.isoformat(),
+            'items': statuses,
+            'score': day_score(target_date),
+            'client': client, # Lets the page that made the change skip its own echo
+        })
+
+def day_state(current_date):
+    """Everything the dashboard shows for one day"""
+    # Cached, time-sorted routine items for the day type (Weekend or Weekday)
+    routine_type = schedule.routine_type_for(current_date)
+    items = schedule.get_schedule(routine_type)
+
+    # Fetch logs for the current_date to see what's completed; older years come from the archive
+    completed_ids = {item_id for item_id, status in archive.day_statuses(current_date).items() if status}
+
+    # Primary: Completed First, Incomplete Second; items are already in time order
+    items = sorted(items, key=lambda item: item['id'] not in completed_ids)
+
+    # Fetch diary entry if exists for current_date
+    diary_entry = DiaryEntry.query.filter_by(date=current_date).first()
+    pinned_text = diary_entry.pinned_text if diary_entry else None
+
+    # The day's own reminders plus recurring ones that fall on it
+    day_reminders = reminders.for_day(current_date)
+
+    # Calculate Score
+    score = completion_score(len(completed_ids), len(items))
+
+    return {
+        'current_date': current_date,
+        'day_name': current_date.strftime("%A"), # e.g., Monday
+        'routine_type': routine_type,
+        'routine_items': items,
+        'completed_ids': completed_ids,
+        'pinned': pinned_text,
+        'reminders': day_reminders,
+        'score': score,
+        'target_score': schedule.get_target_score()
+    }
+
 @app.route('/')
 def dashboard():
     # handling date query param
@@ -32,15 +213,6 @@ def dashboard():
     else:
         current_date = date.today()
 
-    day_name = current_date.strftime("%A") # e.g., Monday
-    
-    # Determine routine type (Weekend or Weekday)
-    # Simple logic: Sat/Sun = Weekend, else Weekday
-    if day_name in ['Saturday', 'Sunday']:
-        routine_filter = 'Weekend'
-    else:
-        routine_filter = 'Weekday'
-
     # Calculate 5-Day Sliding Window for Navigation (Current -2 to +2)
     # This ensures no scrolling is needed and focuses on immediate context
     start_date = current_date - timedelta(days=2)
@@ -54,95 +226,101 @@ def dashboard():
             'is_current': (d == current_date)
         })
 
-    # Fetch routine items for the specific day type
-    items = RoutineItem.query.filter_by(routine_type=routine_filter).all()
-
-    # Fetch logs for the current_date to see what's completed
-    logs = TrackerLog.query.filter_by(date=current_date).all()
-    completed_ids = {log.routine_item_id for log in logs if log.status}
-
-    def parse_time(t_str):
-        try:
-            return datetime.strptime(t_str, "%I:%M %p")
-        except:
-            return datetime.min # Fallback
-
-    def get_sort_key(item):
-        is_completed = item.id in completed_ids
-        # Primary: Completed First (0), Incomplete Second (1)
-        # Secondary: Time
-        return (0 if is_completed else 1, parse_time(item.time_start))
-            
-    items.sort(key=get_sort_key)
-    
-    # Fetch diary entry if exists for current_date
-    diary_entry = DiaryEntry.query.filter_by(date=current_date).first()
-    pinned_text = diary_entry.pinned_text if diary_entry else None
-
-    # Fetch reminders for current_date
-    reminders = Reminder.query.filter_by(date=current_date).all()
-
-    # Calculate Score
-    total_habits = len(items)
-    completed_habits = len(completed_ids)
-    score = int((completed_habits / total_habits * 100)) if total_habits > 0 else 0
-    
-    # Get Target Score
-    target_setting = UserSetting.query.filter_by(key='target_score').first()
-    target_score = int(target_setting.value) if target_setting else 80
-
-    return render_template('index.html', 
-                           routine_items=items, 
-                           completed_ids=completed_ids, 
-                           current_date=current_date,
-                           week_dates=week_dates,
-                           day_name=day_name,
-                           pinned=pinned_text,
-                           reminders=reminders,
-                           score=score,
-                           target_score=target_score)
-
+    return render_template('index.html', week_dates=week_dates, **day_state(current_date))
 
+@app.route('/api/day/<date_str>')
+def day_api(date_str):
+    """Dashboard state for one day, so the page can prefetch and switch days in place"""
+    try:
+        current_date = datetime.strptime(date_str, '%Y-%m-%d').date()
+    except ValueError:
+        abort(404)
+
+    state = day_state(current_date)
+    return jsonify({
+        'date': current_date.isoformat(),
+        'day_name': state['day_name'],
+        'long_date': current_date.strftime('%B %d, %Y'),
+        'short_date': current_date.strftime('%A, %B %d'),
+        'routine_type': state['routine_type'],
+        'items': [dict(item, completed=item['id'] in state['completed_ids']) for item in state['routine_items']],
+        'pinned': state['pinned'],
+        'reminders': [{'id': r.id, 'message': r.message, 'is_completed': r.is_completed, 'time': r.time,
+                       'repeats': reminders.RECURRENCES.get(r.recurrence)} for r in state['reminders']],
+        'score': state['score'],
+        'target_score': state['target_score']
+    })
 
 @app.route('/settings/add', methods=['POST'])
+@database.retry_on_lock
 def add_routine():
     name = request.form.get('name')
     time_start = request.form.get('time_start')
+    time_end = request.form.get('time_end') or None
     routine_type = request.form.get('routine_type')
     description = request.form.get('description')
     
     if name and time_start and routine_type:
+        # Store times in one "06:30 AM" form, so their minute columns are always set
+        start_minute = parse_minute(time_start)
+        end_minute = parse_minute(time_end) if time_end else None
+        if start_minute is None or (time_end and end_minute is None):
+            abort(400)
         new_item = RoutineItem(
             name=name, 
-            time_start=time_start, 
+            time_start=format_minute(start_minute), 
+            time_end=format_minute(end_minute) if time_end else None,
             routine_type=routine_type, 
             description=description
         )
         db.session.add(new_item)
         db.session.commit()
+        schedule.invalidate()
     return redirect(url_for('settings'))
 
 @app.route('/settings/delete/<int:item_id>', methods=['POST'])
+@database.retry_on_lock
 def delete_routine(item_id):
     item = RoutineItem.query.get_or_404(item_id)
+    RoutineRollup.query.filter_by(routine_item_id=item_id).delete()
+    CompletionBitmap.query.filter_by(routine_item_id=item_id).delete()
     db.session.delete(item)
     db.session.commit()
+    schedule.invalidate()
     return redirect(url_for('settings'))
 
 @app.route('/reminders/add', methods=['POST'])
+@database.retry_on_lock
 def add_reminder():
     date_str = request.form.get('date')
     message = request.form.get('message')
+    time_str = request.form.get('time') or None
+    recurrence = request.form.get('recurrence') or None
+    until_str = request.form.get('until') or None
     
     if date_str and message:
-        reminder_date = datetime.strptime(date_str, '%Y-%m-%d').date()
-        new_reminder = Reminder(date=reminder_date, message=message)
+        if recurrence is not None and recurrence not in reminders.RECURRENCES:
+            abort(400)
+        try:
+            reminder_date = datetime.strptime(date_str, '%Y-%m-%d').date()
+            until = datetime.strptime(until_str, '%Y-%m-%d').date() if recurrence and until_str else None
+            if time_str:
+                time_str = datetime.strptime(time_str[:5], '%H:%M').strftime('%H:%M')
+        except ValueError:
+            abort(400)
+        new_reminder = Reminder(date=reminder_date, message=message, time=time_str, recurrence=recurrence, until=until)
         db.session.add(new_reminder)
         db.session.commit()
+        reminders.saved(new_reminder)
+        live.publish('reminder-added', {
+            'id': new_reminder.id, 'message': message, 'is_completed': False, 'time': time_str,
+            'repeats': reminders.RECURRENCES.get(recurrence), 'date': reminder_date.isoformat(),
+        })
         
     return redirect(url_for('dashboard', date=date_str))
 
 @app.route('/toggle_habit/<int:item_id>', methods=['POST'])
+@database.retry_on_lock
 def toggle_habit(item_id):
     # We need to toggle for the SPECIFIC DATE shown on dashboard
     # Passing date via query param or JSON body is best.
@@ -157,21 +335,78 @@ def toggle_habit(item_id):
     else:
         target_date = date.today()
 
-    log = TrackerLog.query.filter_by(date=target_date, routine_item_id=item_id).first()
-    
-    if log:
-        log.status = not log.status
-        db.session.commit()
-        clean_status = log.status
-    else:
-        new_log = TrackerLog(date=target_date, routine_item_id=item_id, status=True)
-        db.session.add(new_log)
-        db.session.commit()
-        clean_status = True
+    # Insert as completed, or flip the existing log, in a single statement.
+    # An archived day's log is brought back first so there is something to flip.
+    archive.restore(target_date, item_id)
+    stmt = insert(TrackerLog).values(date=target_date, routine_item_id=item_id, status=True)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['date', 'routine_item_id'],
+        set_={'status': case((TrackerLog.status == True, False), else_=True)}
+    )
+    clean_status = db.session.execute(stmt.returning(TrackerLog.status)).scalar_one()
+
+    rollups.record_habit(target_date, item_id, clean_status)
+    db.session.commit()
+    publish_habits(target_date, {item_id: clean_status}, data.get('client') if data else None)
         
     return jsonify({'success': True, 'status': clean_status})
 
+HABIT_BATCH_LIMIT = 500
+
+@app.route('/api/habits/batch', methods=['POST'])
+@database.retry_on_lock
+def batch_habits():
+    """Apply many {item_id, date, status} changes in one transaction.
+
+    Statuses are explicit rather than toggles, so a client replaying its
+    offline queue after a dropped response can't flip anything twice.
+    Each op is checked on its own: malformed ones come back in `errors`
+    with their index and the rest are still applied.
+    """
+    data = request.get_json(silent=True)
+    ops = data.get('ops') if isinstance(data, dict) else None
+    if not isinstance(ops, list) or len(ops) > HABIT_BATCH_LIMIT:
+        return jsonify({'success': False, 'error': f'ops must be a list of at most {HABIT_BATCH_LIMIT} changes'}), 400
+
+    changes = []
+    errors = []
+    for index, op in enumerate(ops):
+        try:
+            if not isinstance(op.get('status'), bool):
+                raise ValueError('status must be true or false')
+            changes.append({
+                'date': datetime.strptime(op['date'], '%Y-%m-%d').date(),
+                'routine_item_id': int(op['item_id']),
+                'status': op['status']
+            })
+        except (AttributeError, KeyError, TypeError, ValueError):
+            errors.append({'index': index, 'error': 'An op needs item_id, date (YYYY-MM-DD) and status'})
+
+    # Items deleted while a client was offline are skipped, so its queue still drains
+    known_ids = {item_id for (item_id,) in db.session.query(RoutineItem.id).filter(
+        RoutineItem.id.in_({c['routine_item_id'] for c in changes}))}
+    skipped = sorted({c['routine_item_id'] for c in changes if c['routine_item_id'] not in known_ids})
+    changes = [c for c in changes if c['routine_item_id'] in known_ids]
+
+    if changes:
+        stmt = insert(TrackerLog)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['date', 'routine_item_id'],
+            set_={'status': stmt.excluded.status}
+        )
+        db.session.execute(stmt, changes)
+        rollups.record_habits(changes)
+        db.session.commit()
+        by_date = {}
+        for c in changes:
+            by_date.setdefault(c['date'], {})[c['routine_item_id']] = c['status']
+        for change_date, statuses in by_date.items():
+            publish_habits(change_date, statuses, data.get('client'))
+
+    return jsonify({'success': True, 'applied': len(changes), 'skipped': skipped, 'errors': errors})
+
 @app.route('/diary', methods=['GET', 'POST'])
+@database.retry_on_lock
 def diary():
     today_str = request.args.get('date')
     if today_str:
@@ -182,42 +417,37 @@ def diary():
     else:
         today = date.today()
 
-    entry = DiaryEntry.query.filter_by(date=today).first()
-    
     if request.method == 'POST':
         content = request.form.get('content')
         pinned = request.form.get('pinned_text')
         
-        # Handle multiple files
-        files = request.files.getlist('photos')
-        
-        if not entry:
-            entry = DiaryEntry(date=today, content=content, pinned_text=pinned)
-            db.session.add(entry)
-            db.session.commit() # Commit to get ID
-        else:
-            entry.content = content
-            entry.pinned_text = pinned
-            db.session.commit()
+        entry_id = upsert_diary_entry(today, content=content, pinned_text=pinned)
+        rollups.record_diary(today, content)
 
-        for file in files:
-            if file and allowed_file(file.filename):
-                filename = secure_filename(f"{today}_{datetime.now().microsecond}_{file.filename}")
-                file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-                
-                # Add to DiaryImage table
-                new_image = DiaryImage(diary_entry_id=entry.id, image_path=filename)
-                db.session.add(new_image)
-        
+        # Handle multiple files
+        new_images = save_photos(request.files.getlist('photos'), entry_id)
         db.session.commit()
+        entries.invalidate(entry_id)
+        thumbnails.schedule(app, new_images)
         return redirect(url_for('diary', date=today.isoformat()))
 
+    entry = DiaryEntry.query.filter_by(date=today).first()
     return render_template('diary.html', entry=entry, today=today)
 
 @app.route('/diary/save', methods=['POST'])
+@database.retry_on_lock
 def save_diary():
-    """Auto-save diary entry without page reload"""
-    date_str = request.form.get('date')
+    """Auto-save diary entry without page reload.
+
+    The editor sends JSON {date, base_version, patches: {field: {start, end, text}}}
+    and the patches are only applied if the entry is still at base_version;
+    otherwise the current text comes back with a 409 so the client can rebase.
+    Plain form posts replace the whole entry as before.
+    """
+    data = request.get_json(silent=True)
+    if data is not None and not isinstance(data, dict):
+        return jsonify({'success': False, 'error': 'Invalid request'}), 400
+    date_str = data.get('date') if data else request.form.get('date')
     if date_str:
         try:
             target_date = datetime.strptime(date_str, '%Y-%m-%d').date()
@@ -225,71 +455,229 @@ def save_diary():
             target_date = date.today()
     else:
         target_date = date.today()
-    
-    content = request.form.get('content', '')
-    pinned_text = request.form.get('pinned_text', '')
-    
-    # Get or create entry
+
+    if data is None:
+        content = request.form.get('content', '')
+        pinned_text = request.form.get('pinned_text', '')
+
+        entry_id = upsert_diary_entry(target_date, content=content, pinned_text=pinned_text)
+        rollups.record_diary(target_date, content)
+        db.session.commit()
+        entries.invalidate(entry_id)
+        live.publish('diary', {'date': target_date.isoformat(), 'pinned': pinned_text})
+        return jsonify({'success': True})
+
+    try:
+        base_version = int(data.get('base_version', 0))
+        patches = {k: v for k, v in (data.get('patches') or {}).items() if k in ('content', 'pinned_text')}
+    except (AttributeError, TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'Invalid request'}), 400
+
     entry = DiaryEntry.query.filter_by(date=target_date).first()
-    if not entry:
-        entry = DiaryEntry(date=target_date, content=content, pinned_text=pinned_text)
-        db.session.add(entry)
+    if (entry.version if entry else 0) != base_version:
+        return diary_conflict(entry)
+    if not patches:
+        return jsonify({'success': True, 'version': base_version})
+
+    try:
+        values = {
+            field: apply_patch((getattr(entry, field) if entry else None) or '', patch)
+            for field, patch in patches.items()
+        }
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'Invalid patch'}), 400
+
+    # Only write if nobody else saved since we read the entry
+    if entry:
+        result = db.session.execute(
+            update(DiaryEntry)
+            .where(DiaryEntry.id == entry.id, DiaryEntry.version == base_version)
+            .values(version=base_version + 1, **values)
+        )
     else:
-        entry.content = content
-        entry.pinned_text = pinned_text
-    
+        result = db.session.execute(
+            insert(DiaryEntry)
+            .values(date=target_date, version=1, **values)
+            .on_conflict_do_nothing(index_elements=['date'])
+        )
+    if result.rowcount != 1:
+        db.session.rollback()
+        return diary_conflict(DiaryEntry.query.filter_by(date=target_date).first())
+
+    if 'content' in values:
+        rollups.record_diary(target_date, values['content'])
     db.session.commit()
-    return jsonify({'success': True})
+    if entry:
+        entries.invalidate(entry.id)
+    change = {'date': target_date.isoformat(), 'version': base_version + 1}
+    if 'pinned_text' in values:
+        change['pinned'] = values['pinned_text']
+    live.publish('diary', change)
+    return jsonify({'success': True, 'version': base_version + 1})
+
+def diary_conflict(entry):
+    """409 carrying the entry as it stands, for the editor to rebase onto"""
+    return jsonify({
+        'success': False,
+        'conflict': True,
+        'version': entry.version if entry else 0,
+        'content': (entry.content if entry else None) or '',
+        'pinned_text': (entry.pinned_text if entry else None) or ''
+    }), 409
 
 @app.route('/timetable')
+@versions.conditional('routine_items')
 def timetable():
-    weekday_items = RoutineItem.query.filter_by(routine_type='Weekday').all()
-    weekend_items = RoutineItem.query.filter_by(routine_type='Weekend').all()
+    weekday_items = schedule.ordered(RoutineItem.query.filter_by(routine_type='Weekday')).all()
+    weekend_items = schedule.ordered(RoutineItem.query.filter_by(routine_type='Weekend')).all()
     return render_template('timetable.html', weekday=weekday_items, weekend=weekend_items)
 
+GALLERY_PAGE_SIZE = 60
+TIMELINE_PAGE_SIZE = 20
+
+def parse_cursor(value):
+    """Decode a 'YYYY-MM-DD:id' keyset cursor, or None for the first page"""
+    if not value:
+        return None
+    try:
+        date_part, id_part = value.split(':')
+        return datetime.strptime(date_part, '%Y-%m-%d').date(), int(id_part)
+    except ValueError:
+        abort(400)
+
+def make_cursor(row_date, row_id):
+    return f"{row_date.isoformat()}:{row_id}"
+
+def gallery_page(cursor):
+    """One page of photos, newest day first, plus the cursor for the next page.
+
+    Entries come in the same joined query with only their id and date; the
+    lightbox fetches the text from /api/entry when it opens.
+    """
+    query = (
+        DiaryImage.query.join(DiaryEntry)
+        .options(contains_eager(DiaryImage.entry).load_only(DiaryEntry.id, DiaryEntry.date),
+                 selectinload(DiaryImage.variants))
+        .order_by(DiaryEntry.date.desc(), DiaryImage.id.desc())
+    )
+    if cursor:
+        query = query.filter(tuple_(DiaryEntry.date, DiaryImage.id) < cursor)
+    images = query.limit(GALLERY_PAGE_SIZE + 1).all()
+
+    next_cursor = None
+    if len(images) > GALLERY_PAGE_SIZE:
+        images = images[:GALLERY_PAGE_SIZE]
+        next_cursor = make_cursor(images[-1].entry.date, images[-1].id)
+    return images, next_cursor
+
+def timeline_page(cursor):
+    """One page of entries tagged with their year/month, newest first"""
+    query = (
+        db.session.query(
+            DiaryEntry,
+            func.strftime('%Y', DiaryEntry.date),
+            func.strftime('%m', DiaryEntry.date)
+        )
+        .options(selectinload(DiaryEntry.images).selectinload(DiaryImage.variants))
+        .order_by(DiaryEntry.date.desc(), DiaryEntry.id.desc())
+    )
+    if cursor:
+        query = query.filter(tuple_(DiaryEntry.date, DiaryEntry.id) < cursor)
+    rows = query.limit(TIMELINE_PAGE_SIZE + 1).all()
+
+    next_cursor = None
+    if len(rows) > TIMELINE_PAGE_SIZE:
+        rows = rows[:TIMELINE_PAGE_SIZE]
+        next_cursor = make_cursor(rows[-1][0].date, rows[-1][0].id)
+    entries = [(entry, int(year), calendar.month_name[int(month)]) for entry, year, month in rows]
+    return entries, next_cursor
+
 @app.route('/gallery')
+@versions.conditional('diary_entries', 'diary_images', 'diary_image_variants')
 def gallery():
-    # Fetch all images
-    images = DiaryImage.query.join(DiaryEntry).order_by(DiaryEntry.date.desc()).all()
-    return render_template('gallery.html', images=images)
+    images, next_cursor = gallery_page(None)
+    return render_template('gallery.html', images=images, next_cursor=next_cursor)
+
+@app.route('/api/gallery')
+@versions.conditional('diary_entries', 'diary_images', 'diary_image_variants')
+def gallery_api():
+    images, next_cursor = gallery_page(parse_cursor(request.args.get('cursor')))
+    return jsonify({
+        'items': [{'id': img.id, 'date': img.entry.date.isoformat()} for img in images],
+        'html': render_template('gallery_tiles.html', images=images),
+        'next_cursor': next_cursor
+    })
+
+@app.route('/api/entry/<int:entry_id>')
+def entry_api(entry_id):
+    """One diary entry's date, text and pinned note, for the gallery lightbox"""
+    detail = entries.get(entry_id)
+    if detail is None:
+        abort(404)
+    return jsonify(detail)
 
 @app.route('/timeline')
+@versions.conditional('diary_entries', 'diary_images', 'diary_image_variants')
 def timeline():
-    # Fetch all entries for the timeline
-    entries = DiaryEntry.query.order_by(DiaryEntry.date.desc()).all()
-    
-    # Process for grouping by Year -> Month
-    # Structure: { 2024: { 'January': [entry1, entry2], 'February': [...] } }
-    grouped_data = {}
-    for entry in entries:
-        year = entry.date.year
-        month = entry.date.strftime('%B')
-        
-        if year not in grouped_data:
-            grouped_data[year] = {}
-        if month not in grouped_data[year]:
-            grouped_data[year][month] = []
-            
-        grouped_data[year][month].append(entry)
-        
-    return render_template('timeline.html', grouped_data=grouped_data)
+    entries, next_cursor = timeline_page(None)
+    return render_template('timeline.html', entries=entries, next_cursor=next_cursor)
+
+@app.route('/api/timeline')
+@versions.conditional('diary_entries', 'diary_images', 'diary_image_variants')
+def timeline_api():
+    cursor = parse_cursor(request.args.get('cursor'))
+    entries, next_cursor = timeline_page(cursor)
+    # Don't repeat the year/month headings the previous page already showed
+    previous = (cursor[0].year, calendar.month_name[cursor[0].month]) if cursor else None
+    return jsonify({
+        'items': [{'id': entry.id, 'date': entry.date.isoformat(), 'year': year, 'month': month}
+                  for entry, year, month in entries],
+        'html': render_template('timeline_entries.html', entries=entries, previous=previous),
+        'next_cursor': next_cursor
+    })
+
+SEARCH_PAGE_SIZE = 20
+
+def search_request():
+    query = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    results, has_more = search.search_entries(db.session, query, page, SEARCH_PAGE_SIZE)
+    return query, page, results, has_more
+
+@app.route('/search')
+def search_diary():
+    query, page, results, has_more = search_request()
+    return render_template('search.html', query=query, page=page, results=results, has_more=has_more)
+
+@app.route('/api/search')
+def search_api():
+    query, page, results, has_more = search_request()
+    return jsonify({
+        'items': [dict(r, date=r['date'].isoformat(), content=str(r['content']), pinned_text=str(r['pinned_text']))
+                  for r in results],
+        'page': page,
+        'has_more': has_more
+    })
 
 @app.route('/photo/delete/<int:image_id>', methods=['POST'])
+@database.retry_on_lock
 def delete_photo(image_id):
     image = DiaryImage.query.get_or_404(image_id)
     entry_date = image.entry.date
-    
-    # Remove file from disk
-    try:
-        os.remove(os.path.join(app.config['UPLOAD_FOLDER'], image.image_path))
-    except:
-        pass # File might not exist
+    image_path = image.image_path
+    variant_paths = [variant.image_path for variant in image.variants]
         
     db.session.delete(image)
+    db.session.flush()
+
+    # The same photo may be attached to other days; its files go with the last one.
+    # Released before the commit, while no upload can be storing the same file.
+    photostore.release(shards.upload_folder(), image_path, variant_paths)
     db.session.commit()
     return redirect(url_for('diary', date=entry_date.isoformat()))
 
 @app.route('/photo/upload', methods=['POST'])
+@database.retry_on_lock
 def upload_photo():
     """Direct photo upload without requiring full entry save"""
     date_str = request.form.get('date')
@@ -301,30 +689,18 @@ def upload_photo():
     else:
         target_date = date.today()
     
-    # Get or create diary entry
-    entry = DiaryEntry.query.filter_by(date=target_date).first()
-    if not entry:
-        entry = DiaryEntry(date=target_date, content='', pinned_text='')
-        db.session.add(entry)
-        db.session.commit()
+    # Get or create diary entry, leaving any existing text untouched
+    entry_id = upsert_diary_entry(target_date)
     
     # Handle file upload
-    files = request.files.getlist('photos')
-    uploaded_count = 0
-    
-    for file in files:
-        if file and allowed_file(file.filename):
-            filename = secure_filename(f"{target_date}_{datetime.now().microsecond}_{file.filename}")
-            file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-            
-            new_image = DiaryImage(diary_entry_id=entry.id, image_path=filename)
-            db.session.add(new_image)
-            uploaded_count += 1
-    
+    new_images = save_photos(request.files.getlist('photos'), entry_id)
     db.session.commit()
-    return jsonify({'success': True, 'count': uploaded_count})
+    # Thumbnails are rendered in the background; the page shows originals until they land
+    thumbnails.schedule(app, new_images)
+    return jsonify({'success': True, 'count': len(new_images)})
 
 @app.route('/settings', methods=['GET', 'POST'])
+@database.retry_on_lock
 def settings():
     if request.method == 'POST':
         # Handle Target Score Update
@@ -337,64 +713,252 @@ def settings():
             else:
                 setting.value = target_score
             db.session.commit()
+            schedule.invalidate()
         return redirect(url_for('settings'))
 
-    items = RoutineItem.query.all()
-    
-    def parse_time(t_str):
-        try:
-            return datetime.strptime(t_str, "%I:%M %p")
-        except:
-            return datetime.min
-            
-    items.sort(key=lambda x: (x.routine_type, parse_time(x.time_start)))
+    items = schedule.ordered(RoutineItem.query).all()
     
-    target_score_setting = UserSetting.query.filter_by(key='target_score').first()
-    target_score = target_score_setting.value if target_score_setting else "80"
+    target_score = schedule.get_target_score()
 
     return render_template('settings.html', items=items, target_score=target_score)
 
 @app.route('/analytics')
+@versions.conditional('routine_items', 'routine_rollups', 'completion_bitmaps', 'diary_rollups', daily=True)
 def analytics():
-    # Routine Frequency (Top 10 Most Completed)
-    logs = TrackerLog.query.filter_by(status=True).all()
-    routine_counts = {}
-    for log in logs:
-        item = RoutineItem.query.get(log.routine_item_id)
-        if item:
-            routine_counts[item.name] = routine_counts.get(item.name, 0) + 1
-            
-    sorted_routines = sorted(routine_counts.items(), key=lambda x: x[1], reverse=True)[:10]
+    # Routine Frequency (Top 10 Most Completed), from the daily rollup and the bitmaps of archived years
+    names = dict(db.session.query(RoutineItem.id, RoutineItem.name))
+    totals = defaultdict(int)
+    for item_id, completions in rollups.totals().items():
+        if item_id in names:
+            totals[names[item_id]] += completions
+    sorted_routines = sorted(((name, total) for name, total in totals.items() if total > 0),
+                             key=lambda x: x[1], reverse=True)[:10]
     
     # Diary Activity (Last 7 Days)
     end_date = date.today()
     start_date = end_date - timedelta(days=6)
+    written_days = {
+        row.date for row in DiaryRollup.query.filter(
+            DiaryRollup.date.between(start_date, end_date),
+            DiaryRollup.has_content == True
+        )
+    }
     
     diary_counts = []
     dates = []
     current = start_date
     while current <= end_date:
-        entry = DiaryEntry.query.filter_by(date=current).first()
         dates.append(current.strftime('%a')) # 'Mon', 'Tue'
-        diary_counts.append(1 if (entry and entry.content) else 0)
+        diary_counts.append(1 if current in written_days else 0)
         current += timedelta(days=1)
         
     # Category Distribution
-    all_items = RoutineItem.query.all()
-    categories = {}
-    for item in all_items:
-        cat = item.category or 'Uncategorized'
-        categories[cat] = categories.get(cat, 0) + 1
+    categories = (
+        db.session.query(func.coalesce(RoutineItem.category, 'Uncategorized'), func.count(RoutineItem.id))
+        .group_by(func.coalesce(RoutineItem.category, 'Uncategorized'))
+        .all()
+    )
         
     return render_template('analytics.html', 
                          routines_labels=[x[0] for x in sorted_routines],
                          routines_data=[x[1] for x in sorted_routines],
                          diary_labels=dates,
                          diary_data=diary_counts,
-                         category_labels=list(categories.keys()),
-                         category_data=list(categories.values()))
+                         category_labels=[x[0] for x in categories],
+                         category_data=[x[1] for x in categories])
+
+@app.route('/api/streaks')
+@versions.conditional('routine_items', 'tracker_logs', daily=True)
+def streaks_api():
+    """Per-routine streaks and rates, the year heatmap and the rolling 7-day rate"""
+    return jsonify(streaks.compute())
+
+SCORE_RANGE_LIMIT = 3660 # Days, about ten years
+
+@app.route('/api/scores')
+@versions.conditional('routine_items', 'completion_bitmaps', daily=True)
+def scores_api():
+    """Daily, weekly and monthly completion for ?from=&to= (the last year by default), optionally one routine_type"""
+    try:
+        to_date = datetime.strptime(request.args['to'], '%Y-%m-%d').date() if request.args.get('to') else date.today()
+        from_date = (datetime.strptime(request.args['from'], '%Y-%m-%d').date() if request.args.get('from')
+                     else to_date - timedelta(days=364))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'from and to must be YYYY-MM-DD'}), 400
+    routine_type = request.args.get('routine_type') or None
+    if routine_type is not None and routine_type not in bitmaps.ROUTINE_TYPES:
+        return jsonify({'success': False, 'error': f"routine_type must be one of {', '.join(bitmaps.ROUTINE_TYPES)}"}), 400
+    if not 0 <= (to_date - from_date).days < SCORE_RANGE_LIMIT:
+        return jsonify({'success': False, 'error': f'from must be on or before to, at most {SCORE_RANGE_LIMIT} days apart'}), 400
+    return jsonify(bitmaps.scores(from_date, to_date, routine_type))
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus scrape target"""
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+def download(chunks, filename, mimetype):
+    """Stream a generator to the browser as a file download"""
+    return Response(stream_with_context(chunks), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+@app.route('/export/journal.ndjson')
+def export_journal():
+    return download(backup.export_ndjson(), f"dailyfocus-{date.today()}.ndjson", 'application/x-ndjson')
+
+@app.route('/export/<table>.csv')
+def export_table(table):
+    if table not in backup.TABLES:
+        abort(404)
+    return download(backup.export_csv(table), f"{table}-{date.today()}.csv", 'text/csv')
+
+@app.route('/export/photos.tar')
+def export_photos():
+    return download(backup.export_photos(shards.upload_folder()), f"photos-{date.today()}.tar", 'application/x-tar')
+
+@app.cli.command('rebuild-rollups')
+@shards.user_option
+def rebuild_rollups_command():
+    """Recompute the analytics rollup tables from the full history."""
+    migrations.upgrade()
+    rollups.rebuild()
+    print("Rollups rebuilt.")
+
+@app.cli.command('archive-logs')
+@click.option('--before', type=int, help="Archive years before this one (default: the current year).")
+@click.option('--vacuum', is_flag=True, help="Reclaim the freed space in the database file afterwards.")
+@shards.user_option
+def archive_logs_command(before, vacuum):
+    """Move closed years of habit logs into compressed per-year archive files."""
+    this_year = date.today().year
+    before = before or this_year
+    if before > this_year:
+        raise click.UsageError("Only closed years can be archived; --before can't be after the current year.")
+    migrations.upgrade()
+    years = sorted(int(year) for (year,) in db.session.query(func.strftime('%Y', TrackerLog.date))
+                   .filter(TrackerLog.date < date(before, 1, 1)).distinct())
+    for year in years:
+        print(f"{year}: archived {archive.archive_year(year)} log(s).")
+    if vacuum:
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            conn.exec_driver_sql('VACUUM')
+    print(f"Archived {len(years)} year(s) into {archive.folder()}.")
+
+@app.cli.command('build-thumbnails')
+@shards.user_option
+def build_thumbnails_command():
+    """Render resized variants for photos uploaded before they existed."""
+    migrations.upgrade()
+    missing = DiaryImage.query.filter(~DiaryImage.variants.any()).all()
+    thumbnails.schedule(app, missing)
+    thumbnails.shutdown()
+    print(f"Built variants for {len(missing)} photo(s).")
+
+@app.cli.command('export-journal')
+@click.argument('path')
+@click.option('--photos', help="Also write the uploads folder to this tar file.")
+@shards.user_option
+def export_journal_command(path, photos):
+    """Write every table to an NDJSON file."""
+    migrations.upgrade()
+    with open(path, 'w', encoding='utf-8', newline='\n') as f:
+        f.writelines(backup.export_ndjson())
+    if photos:
+        with open(photos, 'wb') as f:
+            f.writelines(backup.export_photos(shards.upload_folder()))
+    print(f"Exported journal to {path}.")
+
+@app.cli.command('import-journal')
+@click.argument('paths', nargs=-1, required=True)
+@click.option('--photos', help="Unpack this tar of photos into the uploads folder.")
+@click.option('--replace', is_flag=True, help="Delete the existing journal first.")
+@shards.user_option
+def import_journal_command(paths, photos, replace):
+    """Load an NDJSON export, or per-table CSVs named after their table."""
+    migrations.upgrade()
+    if replace:
+        backup.clear_all()
+    elif not backup.is_empty():
+        raise click.ClickException("The database already has data; pass --replace to overwrite it.")
+
+    counts = {}
+    for path in paths:
+        with open(path, encoding='utf-8', newline='') as f:
+            if path.endswith('.csv'):
+                table = os.path.basename(path)[:-len('.csv')].split('-')[0]
+                if table not in backup.TABLES:
+                    raise click.ClickException(f"{path}: file name must start with a table name")
+                result = backup.import_csv(table, f)
+            else:
+                result = backup.import_ndjson(f)
+        for table, n in result.items():
+            counts[table] = counts.get(table, 0) + n
+    rollups.rebuild()
+    schedule.invalidate()
+    entries.invalidate()
+    if photos:
+        with open(photos, 'rb') as f:
+            print(f"Unpacked {backup.import_photos(f, shards.upload_folder())} photo file(s).")
+    print("Imported " + ', '.join(f"{k}={v}" for k, v in counts.items() if v) + ".")
+
+@app.cli.command('dedupe-photos')
+@shards.user_option
+def dedupe_photos_command():
+    """Re-store photos uploaded before content addressing under their hashes, merging duplicates."""
+    migrations.upgrade()
+    checked, freed = photostore.dedupe_existing(shards.upload_folder())
+    print(f"Checked {checked} photo(s), freed {freed / (1024 * 1024):.1f} MB.")
+
+@app.cli.command('create-user')
+@click.argument('username')
+@click.password_option()
+def create_user_command(username, password):
+    """Add an account, with its own database shard, for SHARDING mode."""
+    migrations.upgrade_directory()
+    if User.query.filter_by(username=username).first():
+        raise click.ClickException(f"User {username} already exists.")
+    user = User(username=username, password_hash=generate_password_hash(password),
+                bucket=shards.bucket_for(username, app.config['SHARD_BUCKETS']))
+    db.session.add(user)
+    db.session.commit()
+    shards.engine_for(user.shard) # Opening a shard creates and migrates its database
+    print(f"Created {username} in shard bucket {user.bucket}.")
+
+@app.cli.command('rebalance-shards')
+@click.option('--buckets', type=int, help="New number of bucket directories (default: SHARD_BUCKETS).")
+@click.option('--by-size', is_flag=True, help="Spread users so buckets hold similar amounts of data, instead of by username hash.")
+@click.option('--dry-run', is_flag=True, help="Only print the moves.")
+def rebalance_shards_command(buckets, by_size, dry_run):
+    """Move user databases between bucket directories. Stop the server first."""
+    migrations.upgrade_directory()
+    buckets = buckets or app.config['SHARD_BUCKETS']
+    root = app.config['SHARD_ROOT']
+    users = User.query.order_by(User.id).all()
+    sizes = None
+    if by_size:
+        sizes = {}
+        for user in users:
+            path = shards.database_path(user.shard, root)
+            sizes[user.id] = sum(os.path.getsize(p) for p in (path, path + '-wal') if os.path.exists(p))
+    plan = shards.plan_rebalance([(user.id, user.username) for user in users], buckets, sizes)
+
+    shards.dispose_all() # No open handles on files about to move
+    moved = 0
+    for user in users:
+        target = plan[user.id]
+        if target == user.bucket:
+            continue
+        print(f"{user.username}: bucket {user.bucket} -> {target}")
+        if not dry_run:
+            shards.move(user.shard, target, root)
+            user.bucket = target
+            db.session.commit() # Per user, so an interrupted run leaves the directory matching the files
+        moved += 1
+    print(f"{'Would move' if dry_run else 'Moved'} {moved} of {len(users)} user(s) across {buckets} bucket(s).")
 
 if __name__ == '__main__':
     with app.app_context():
-        db.create_all()
+        migrations.upgrade()
+        if app.config['SHARDING']:
+            migrations.upgrade_directory()
     app.run(host='0.0.0.0', port=5000, debug=True)
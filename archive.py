@@ -0,0 +1,212 @@
+"""Cold storage for closed years of habit logs.
+
+`tracker_logs` grows by a row per routine item per day. `flask --app app
+archive-logs` moves every year before the current one out of SQLite into
+one compressed, columnar file per year, `tracker_logs-<year>.npz` in a
+folder next to the database file it came from (`<database>.archive/`, so
+every shard, benchmark or DATABASE_URL database has its own): the day numbers, item ids and statuses as three NumPy
+arrays sorted by day. A year of a 20-item routine compresses to a few KB.
+The live database keeps only recent rows, so it stays small to vacuum and
+back up. The year's daily routine rollups go too; analytics counts archived
+years from the completion bitmaps (see rollups.totals).
+
+Code that reads logs goes through this module rather than the table. The
+table is checked first and the archive fills in the rest, so a habit
+ticked on an archived day after the fact simply lives in the table again
+and wins over the archived status. Archiving that year again folds it in.
+
+Archived rows have no ids. The exporter writes them after the table's own
+rows, with an empty id, and the importer numbers them afresh.
+"""
+import os
+from datetime import date
+from functools import lru_cache
+from itertools import chain
+import numpy as np
+from sqlalchemy import Integer, cast, func
+from sqlalchemy.dialects.sqlite import insert
+from models import db, TrackerLog, RoutineRollup
+import bitmaps
+
+
+def folder():
+    """The active database's archive folder, beside its file; None for an in-memory database"""
+    database = db.engine.url.database # Follows the active shard
+    if not database or database == ':memory:' or database.startswith('file:'):
+        return None
+    return database + '.archive'
+
+
+def _path(year):
+    path = folder()
+    return os.path.join(path, f'tracker_logs-{year}.npz') if path else None
+
+
+def years():
+    """Archived years, oldest first"""
+    path = folder()
+    if path is None:
+        return []
+    try:
+        names = os.listdir(path)
+    except FileNotFoundError:
+        return []
+    return sorted(int(name[len('tracker_logs-'):-len('.npz')]) for name in names
+                  if name.startswith('tracker_logs-') and name.endswith('.npz'))
+
+
+@lru_cache(maxsize=16)
+def _read(path, mtime_ns):
+    # Keyed on the modification time, so a year that's archived again is read afresh
+    with np.load(path) as columns:
+        return columns['day'], columns['routine_item_id'], columns['status']
+
+
+def _columns(year):
+    """(days, item ids, statuses) archived for a year, or None"""
+    path = _path(year)
+    if path is None:
+        return None
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    return _read(path, mtime_ns)
+
+
+def _keys(days, item_ids):
+    return np.asarray(days, dtype=np.int64) << 32 | np.asarray(item_ids, dtype=np.int64)
+
+
+def _fetch(query, width):
+    """A query's integer columns as one int64 array of `width` columns"""
+    result = db.session.connection().execute(query)
+    rows = result.cursor.fetchall() # Plain DB-API tuples; wrapping every log in a Row costs more than the maths
+    result.close()
+    return np.fromiter(chain.from_iterable(rows), dtype=np.int64, count=width * len(rows)).reshape(-1, width)
+
+
+def _day():
+    return cast(func.julianday(TrackerLog.date) - bitmaps.UNIX_JULIAN_DAY, Integer)
+
+
+def _table_rows(first, last):
+    """(day numbers, item ids, statuses) of the table's rows between two dates"""
+    columns = _fetch(
+        db.select(_day(), TrackerLog.routine_item_id, func.coalesce(TrackerLog.status, False))
+        .where(TrackerLog.date >= first, TrackerLog.date <= last),
+        3
+    )
+    return columns[:, 0], columns[:, 1], columns[:, 2].astype(bool)
+
+
+def _archived(year):
+    """A year's archived (days, item ids, statuses), minus the rows the table overrides"""
+    columns = _columns(year)
+    if columns is None:
+        return None
+    days, item_ids, statuses = columns
+    table_days, table_items, _ = _table_rows(date(year, 1, 1), date(year, 12, 31))
+    if len(table_days):
+        keep = ~np.isin(_keys(days, item_ids), _keys(table_days, table_items))
+        days, item_ids, statuses = days[keep], item_ids[keep], statuses[keep]
+    return days, item_ids, statuses
+
+
+def day_statuses(day):
+    """{routine_item_id: status} logged for one day"""
+    statuses = dict(db.session.query(TrackerLog.routine_item_id, TrackerLog.status).filter_by(date=day))
+    columns = _columns(day.year)
+    if columns is not None:
+        days, item_ids, archived = columns
+        number = bitmaps.day_number(day)
+        first, last = np.searchsorted(days, [number, number + 1])
+        for item_id, status in zip(item_ids[first:last].tolist(), archived[first:last].tolist()):
+            statuses.setdefault(item_id, status)
+    return statuses
+
+
+def is_archived(day):
+    path = _path(day.year)
+    return path is not None and os.path.exists(path)
+
+
+def completed(until=None):
+    """Day numbers and item ids of every completed log up to `until`, as two int64 arrays"""
+    query = db.select(_day(), TrackerLog.routine_item_id).where(TrackerLog.status == True)
+    if until is not None:
+        query = query.where(TrackerLog.date <= until)
+    logs = _fetch(query, 2)
+    days, item_ids = [logs[:, 0]], [logs[:, 1]]
+
+    for year in years():
+        if until is not None and year > until.year:
+            break
+        archived_days, archived_items, statuses = _archived(year)
+        if until is not None:
+            statuses = statuses & (archived_days <= bitmaps.day_number(until))
+        days.append(archived_days[statuses].astype(np.int64))
+        item_ids.append(archived_items[statuses].astype(np.int64))
+    return np.concatenate(days), np.concatenate(item_ids)
+
+
+def archived_rows():
+    """Dicts of every archived log the table doesn't override, oldest first"""
+    for year in years():
+        days, item_ids, statuses = _archived(year)
+        for day, item_id, status in zip(days.tolist(), item_ids.tolist(), statuses.tolist()):
+            yield {'id': None, 'date': bitmaps.to_date(day), 'routine_item_id': item_id, 'status': status}
+
+
+def restore(day, item_id):
+    """Copy one archived log back into the table, so a toggle flips the archived status"""
+    if not is_archived(day):
+        return
+    status = day_statuses(day).get(item_id)
+    if status is not None:
+        db.session.execute(
+            insert(TrackerLog).values(date=day, routine_item_id=item_id, status=status)
+            .on_conflict_do_nothing(index_elements=['date', 'routine_item_id'])
+        )
+
+
+def _write(year, days, item_ids, statuses):
+    """Replace a year's archive file; written aside and renamed, so readers never see half a file"""
+    if folder() is None:
+        raise RuntimeError("Only a database stored in a file can archive its logs")
+    os.makedirs(folder(), exist_ok=True)
+    path = _path(year)
+    order = np.lexsort((item_ids, days))
+    with open(path + '.tmp', 'wb') as f:
+        np.savez_compressed(f, day=days[order].astype(np.int32), routine_item_id=item_ids[order].astype(np.int32),
+                            status=statuses[order].astype(bool))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+
+def archive_year(year):
+    """Move a year's rows from the table into its archive file and drop its rollups; returns how many rows moved"""
+    first, last = date(year, 1, 1), date(year, 12, 31)
+    days, item_ids, statuses = _table_rows(first, last)
+    moved = len(days)
+    if not moved:
+        return 0
+    previous = _archived(year) # Earlier archive of this year, minus what the table now overrides
+    if previous is not None:
+        days = np.concatenate([days, previous[0]])
+        item_ids = np.concatenate([item_ids, previous[1]])
+        statuses = np.concatenate([statuses, previous[2]])
+    _write(year, days, item_ids, statuses)
+
+    # Until this commits the rows are in both places, and the table's copy wins with the same values
+    TrackerLog.query.filter(TrackerLog.date >= first, TrackerLog.date <= last).delete()
+    RoutineRollup.query.filter(RoutineRollup.date >= first, RoutineRollup.date <= last).delete()
+    db.session.commit()
+    return moved
+
+
+def clear():
+    """Delete the active user's archive files"""
+    for year in years():
+        os.remove(_path(year))
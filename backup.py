@@ -0,0 +1,180 @@
+"""Streaming export and bulk import of the whole journal.
+
+Exports are generators: rows are read from SQLite in batches and written
+out line by line as NDJSON (every table in one file, each line tagged with
+its table) or as one CSV per table. Photos stream as an uncompressed tar,
+one chunk at a time. Memory stays flat however large the journal is.
+
+The importer reads the same formats back with executemany inserts,
+committing every BATCH_SIZE rows.
+"""
+import csv
+import io
+import json
+import os
+import tarfile
+from datetime import date
+from sqlalchemy import Boolean, Date, Integer, insert
+from models import db, RoutineItem, TrackerLog, DiaryEntry, DiaryImage, DiaryImageVariant, Reminder, UserSetting
+import archive
+
+# Parents before children, so an import never references a row it hasn't seen yet
+MODELS = [RoutineItem, UserSetting, DiaryEntry, DiaryImage, DiaryImageVariant, TrackerLog, Reminder]
+TABLES = {model.__tablename__: model.__table__ for model in MODELS}
+
+BATCH_SIZE = 5000
+CHUNK_SIZE = 64 * 1024
+
+
+def _rows(table):
+    """Yield a table's rows as dicts, BATCH_SIZE at a time from the database.
+
+    Habit logs moved to the archive follow the table's own, without ids.
+    """
+    result = db.session.execute(db.select(*table.columns).order_by(*table.primary_key.columns)
+                                .execution_options(yield_per=BATCH_SIZE))
+    for row in result.mappings():
+        yield row
+    if table is TrackerLog.__table__:
+        yield from archive.archived_rows()
+
+
+def _to_json(value):
+    return value.isoformat() if isinstance(value, date) else value
+
+
+def export_ndjson():
+    """Every table as newline-delimited JSON, one row per line"""
+    for name, table in TABLES.items():
+        for row in _rows(table):
+            record = {'table': name}
+            record.update((k, _to_json(v)) for k, v in row.items())
+            yield json.dumps(record, ensure_ascii=False) + '\n'
+
+
+def export_csv(name):
+    """One table as CSV with a header row"""
+    table = TABLES[name]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(table.columns.keys())
+    for row in _rows(table):
+        writer.writerow(['' if v is None else _to_json(v) for v in row.values()])
+        if buffer.tell() >= CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def export_photos(upload_folder):
+    """Stream every file in the upload folder as a tar archive"""
+    for filename in sorted(os.listdir(upload_folder)):
+        path = os.path.join(upload_folder, filename)
+        if not os.path.isfile(path):
+            continue
+        info = tarfile.TarInfo(filename)
+        stat = os.stat(path)
+        info.size, info.mtime = stat.st_size, int(stat.st_mtime)
+        yield info.tobuf(format=tarfile.PAX_FORMAT)
+        with open(path, 'rb') as f:
+            while chunk := f.read(CHUNK_SIZE):
+                yield chunk
+        padding = -info.size % tarfile.BLOCKSIZE
+        if padding:
+            yield tarfile.NUL * padding
+    yield tarfile.NUL * (2 * tarfile.BLOCKSIZE) # End-of-archive marker
+
+
+def _converters(table):
+    """Per-column parsers turning exported text/JSON values back into Python values"""
+    converters = {}
+    for column in table.columns:
+        if isinstance(column.type, Date):
+            converters[column.name] = lambda v: date.fromisoformat(v) if v else None
+        elif isinstance(column.type, Boolean):
+            converters[column.name] = lambda v: v if isinstance(v, bool) or v is None else v in ('1', 'True', 'true')
+        elif isinstance(column.type, Integer):
+            converters[column.name] = lambda v: int(v) if v not in (None, '') else None
+        else:
+            converters[column.name] = lambda v: v
+    return converters
+
+
+class Importer:
+    """Buffers rows per table and writes them in executemany batches"""
+
+    def __init__(self):
+        self.pending = {name: [] for name in TABLES}
+        self.converters = {name: _converters(table) for name, table in TABLES.items()}
+        self.counts = {name: 0 for name in TABLES}
+
+    def add(self, name, record):
+        if name not in TABLES:
+            raise ValueError(f"Unknown table {name!r}")
+        convert = self.converters[name]
+        self.pending[name].append({k: convert[k](v) for k, v in record.items() if k in convert})
+        if len(self.pending[name]) >= BATCH_SIZE:
+            self.flush(name)
+
+    def flush(self, name=None):
+        """Write the buffered rows of `name` and of every table before it, or of all tables"""
+        names = list(TABLES)
+        if name:
+            names = names[:names.index(name) + 1] # Parents' pending rows go first, so children never get ahead
+        for table_name in names:
+            rows = self.pending[table_name]
+            if rows:
+                db.session.execute(insert(TABLES[table_name]), rows)
+                db.session.commit()
+                self.counts[table_name] += len(rows)
+                self.pending[table_name] = []
+
+
+def clear_all():
+    """Delete every row the export covers, children first, and the archived logs"""
+    for table in reversed(list(TABLES.values())):
+        db.session.execute(table.delete())
+    db.session.commit()
+    archive.clear()
+
+
+def is_empty():
+    return (all(db.session.execute(db.select(t.columns[0]).limit(1)).first() is None for t in TABLES.values())
+            and not archive.years())
+
+
+def import_ndjson(lines):
+    importer = Importer()
+    for line in lines:
+        if line.strip():
+            record = json.loads(line)
+            importer.add(record.pop('table'), record)
+    importer.flush()
+    return importer.counts
+
+
+def import_csv(name, lines):
+    """CSV has no NULL, so empty cells in nullable columns load as NULL"""
+    importer = Importer()
+    nullable = {column.name for column in TABLES[name].columns if column.nullable}
+    for record in csv.DictReader(lines):
+        importer.add(name, {k: None if v == '' and k in nullable else v for k, v in record.items()})
+    importer.flush()
+    return importer.counts
+
+
+def import_photos(fileobj, upload_folder):
+    """Unpack a photo tar into the upload folder, ignoring anything that isn't a plain file name"""
+    count = 0
+    with tarfile.open(fileobj=fileobj, mode='r|*') as archive:
+        for member in archive:
+            name = os.path.basename(member.name)
+            if not member.isfile() or name != member.name or name.startswith('.'):
+                continue
+            source = archive.extractfile(member)
+            with open(os.path.join(upload_folder, name), 'wb') as target:
+                while chunk := source.read(CHUNK_SIZE):
+                    target.write(chunk)
+            count += 1
+    return count
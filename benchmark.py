@@ -0,0 +1,164 @@
+"""Per-route latency, query count and memory benchmarks at several data scales.
+
+For each scale a synthetic database is generated (see generate_data.py) in
+a fresh process, then every route in verify.ROUTES is requested through the
+test client. Results are written as JSON so runs can be compared across
+commits:
+
+    python benchmark.py --years 1 3 5 --output bench/baseline.json
+    python benchmark.py --years 1 3 5 --compare bench/baseline.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+# A route is reported as a regression when it gets this much slower
+REGRESSION_THRESHOLD = 0.20
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def run_scale(scale, requests, workdir):
+    """Generate one dataset and time every route against it. Runs in a child process."""
+    database = os.path.join(workdir, f"bench_{scale['years']}y.db")
+    os.environ['DATABASE_URL'] = 'sqlite:///' + database
+
+    from sqlalchemy import event
+    from app import app, db
+    from generate_data import generate
+    from verify import ROUTES
+
+    # Repeat GETs would otherwise be answered from the rendered-page cache and time nothing
+    app.config['PAGE_CACHE_SIZE'] = 0
+
+    with app.app_context():
+        started = time.perf_counter()
+        rows = generate(**scale)
+        generate_seconds = time.perf_counter() - started
+
+        query_count = [0]
+
+        def count_query(*args):
+            query_count[0] += 1
+        event.listen(db.engine, 'before_cursor_execute', count_query)
+
+        client = app.test_client()
+        routes = {}
+        for route in ROUTES:
+            client.get(route) # Warm caches and connections
+
+            timings = []
+            for _ in range(requests):
+                query_count[0] = 0
+                started = time.perf_counter()
+                response = client.get(route)
+                timings.append((time.perf_counter() - started) * 1000)
+                if response.status_code != 200:
+                    raise RuntimeError(f"{route} returned {response.status_code}")
+            queries = query_count[0]
+
+            # Memory is measured on a separate request so tracing doesn't skew latency
+            tracemalloc.start()
+            client.get(route)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            routes[route] = {
+                'p50_ms': round(percentile(timings, 50), 2),
+                'p95_ms': round(percentile(timings, 95), 2),
+                'p99_ms': round(percentile(timings, 99), 2),
+                'mean_ms': round(statistics.fmean(timings), 2),
+                'queries': queries,
+                'peak_kb': round(peak / 1024, 1),
+                'response_kb': round(len(response.data) / 1024, 1),
+            }
+
+    return {'scale': scale, 'rows': rows, 'generate_seconds': round(generate_seconds, 2), 'routes': routes}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline=None):
+    previous = {}
+    for scale in (baseline or {}).get('scales', []):
+        previous[scale['scale']['years']] = scale['routes']
+
+    regressions = []
+    for scale in results['scales']:
+        rows = scale['rows']
+        print(f"\n== {scale['scale']['years']} year(s): {rows['tracker_logs']} logs, "
+              f"{rows['diary_entries']} entries, {rows['diary_images']} photos ==")
+        print(f"{'route':<12}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'queries':>9}{'peak KB':>10}{'vs base':>10}")
+        for route, stats in scale['routes'].items():
+            change = ''
+            old = previous.get(scale['scale']['years'], {}).get(route)
+            if old and old['p50_ms']:
+                ratio = stats['p50_ms'] / old['p50_ms'] - 1
+                change = f"{ratio:+.0%}"
+                if ratio > REGRESSION_THRESHOLD:
+                    regressions.append((scale['scale']['years'], route, change))
+            print(f"{route:<12}{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}"
+                  f"{stats['queries']:>9}{stats['peak_kb']:>10}{change:>10}")
+
+    for years, route, change in regressions:
+        print(f"REGRESSION: {route} at {years} year(s) is {change} slower than the baseline")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--years', type=float, nargs='+', default=[1, 3, 5], help="History lengths to test")
+    parser.add_argument('--routines', type=int, default=20, help="Items per day type")
+    parser.add_argument('--fill-rate', type=float, default=0.7)
+    parser.add_argument('--photos-per-day', type=float, default=2.0)
+    parser.add_argument('--requests', type=int, default=30, help="Timed requests per route")
+    parser.add_argument('--output', help="Write results JSON here")
+    parser.add_argument('--compare', help="Baseline JSON to compare against")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    # Each scale gets its own process so the app binds to that scale's database
+    context = multiprocessing.get_context('spawn')
+    scales = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for years in args.years:
+            scale = {'years': years, 'routines': args.routines, 'fill_rate': args.fill_rate,
+                     'photos_per_day': args.photos_per_day}
+            with context.Pool(1) as pool:
+                scales.append(pool.apply(run_scale, (scale, args.requests, workdir)))
+
+    results = {'commit': git_commit(), 'created': datetime.now().isoformat(timespec='seconds'), 'scales': scales}
+    regressions = print_results(results, baseline)
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nSaved results to {args.output}")
+
+    raise SystemExit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
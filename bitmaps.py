@@ -0,0 +1,224 @@
+"""Per-routine completion bitmaps for score queries over any date range.
+
+Every routine item has one bit per day, set when it was completed, kept as
+a BLOB in `completion_bitmaps` next to the logs it mirrors. `rollups`
+flips bits in the same transaction as each habit write and regenerates
+them on rebuild. Five years of a 20-item routine is about 9 KB, against
+megabytes of log rows.
+
+Each process stacks the bitmaps of a routine type into one byte matrix and
+keeps it until their data version moves. A range query unpacks only the
+bytes the range spans and counts the set bits per day, then sums those
+counts into weeks and months. A cell only counts on days its item applies
+(Weekend items on Saturdays and Sundays), as in streaks.py.
+"""
+from collections import defaultdict
+from datetime import date
+import numpy as np
+from models import db, RoutineItem, TrackerLog, CompletionBitmap
+import archive
+import shards
+import versions
+
+EPOCH = date(1970, 1, 1)
+UNIX_JULIAN_DAY = 2440587.5 # julianday('1970-01-01'), for day numbers computed in SQL
+ROUTINE_TYPES = ('Weekday', 'Weekend')
+
+_cache = {} # shard -> (data version, {routine_type: (start_day, matrix, item ids)})
+
+
+def day_number(day):
+    """Days since EPOCH: the day index of the bitmaps, the archive files and the streak matrix"""
+    return (day - EPOCH).days
+
+
+def to_date(number):
+    return date.fromordinal(EPOCH.toordinal() + int(number))
+
+
+def weekdays(numbers):
+    """Day of the week of each day number, Monday being 0"""
+    return (np.asarray(numbers) + 3) % 7 # 1970-01-01 was a Thursday
+
+
+def weekends(numbers):
+    return weekdays(numbers) >= 5
+
+
+def applies(routine_type, weekend):
+    """Which days of a weekend mask a routine type is scheduled on (schedule.routine_type_for)"""
+    if routine_type == 'Weekend':
+        return weekend
+    if routine_type == 'Weekday':
+        return ~weekend
+    return np.zeros_like(weekend) # Other routine types are never scheduled
+
+
+def _set_bits(start, data, changes):
+    """Apply (day number, status) changes to a bitmap, growing it as needed; returns the new start"""
+    days = [day for day, _ in changes]
+    low = min(days) // 8 * 8
+    if start is None:
+        start = low
+    elif low < start:
+        data[:0] = bytes((start - low) // 8)
+        start = low
+    needed = (max(days) - start) // 8 + 1
+    if len(data) < needed:
+        data.extend(bytes(needed - len(data)))
+    for day, status in changes:
+        offset = day - start
+        if status:
+            data[offset >> 3] |= 1 << (offset & 7)
+        else:
+            data[offset >> 3] &= ~(1 << (offset & 7)) & 0xFF
+    return start
+
+
+def record(changes):
+    """Set or clear the bits for {date, routine_item_id, status} changes; the caller commits"""
+    by_item = defaultdict(list)
+    for c in changes:
+        by_item[c['routine_item_id']].append((day_number(c['date']), c['status']))
+    _apply(by_item)
+
+
+def _apply(by_item):
+    """Write {item id: [(day number, status)]} into the items' bitmap rows"""
+    rows = {row.routine_item_id: row for row in
+            CompletionBitmap.query.filter(CompletionBitmap.routine_item_id.in_(list(by_item)))}
+    for item_id, item_changes in by_item.items():
+        row = rows.get(item_id)
+        data = bytearray(row.bits) if row else bytearray()
+        start = _set_bits(row.start_day if row else None, data, item_changes)
+        if row:
+            row.start_day, row.bits = start, bytes(data)
+        else:
+            db.session.add(CompletionBitmap(routine_item_id=item_id, start_day=start, bits=bytes(data)))
+
+
+def rebuild():
+    """Regenerate every bitmap from the completed logs, archived ones included; the caller commits"""
+    CompletionBitmap.query.delete()
+    days, item_ids = archive.completed()
+    by_item = defaultdict(list)
+    for day, item_id in zip(days.tolist(), item_ids.tolist()):
+        by_item[item_id].append((day, True))
+    if by_item:
+        _apply(by_item)
+
+
+def needs_backfill():
+    """True for a database with completed logs but no bitmaps yet"""
+    return (db.session.query(CompletionBitmap.routine_item_id).first() is None
+            and (db.session.query(TrackerLog.id).filter(TrackerLog.status == True).first() is not None
+                 or bool(archive.years())))
+
+
+def _matrices():
+    """{routine_type: (start day, items x bytes matrix, item ids)}, reloaded when the bitmaps change"""
+    shard = shards.current()
+    version, _ = versions.current(['routine_items', 'completion_bitmaps'])
+    cached = _cache.get(shard)
+    if cached and cached[0] == version:
+        return cached[1]
+
+    bitmaps = {row.routine_item_id: row for row in CompletionBitmap.query}
+    matrices = {}
+    for routine_type in ROUTINE_TYPES:
+        item_ids = [item_id for (item_id,) in
+                    db.session.query(RoutineItem.id).filter_by(routine_type=routine_type).order_by(RoutineItem.id)]
+        rows = [bitmaps[item_id] for item_id in item_ids if item_id in bitmaps]
+        start = min((row.start_day for row in rows), default=0)
+        width = max((row.start_day - start) // 8 + len(row.bits) for row in rows) if rows else 0
+        matrix = np.zeros((len(item_ids), width), dtype=np.uint8)
+        for i, row in enumerate(rows):
+            offset = (row.start_day - start) // 8
+            matrix[i, offset:offset + len(row.bits)] = np.frombuffer(row.bits, dtype=np.uint8)
+        matrices[routine_type] = (start, matrix, item_ids)
+    _cache[shard] = (version, matrices)
+    return matrices
+
+
+def _bits(start, matrix, first_day, days):
+    """The items x days bits that fall within `days` days from `first_day`, and the first one's offset"""
+    low = max(first_day, start)
+    high = min(first_day + days, start + matrix.shape[1] * 8) # Exclusive
+    if low >= high or not matrix.shape[0]:
+        return None, 0
+    first_byte, last_byte = (low - start) // 8, (high - start + 7) // 8
+    bits = np.unpackbits(matrix[:, first_byte:last_byte], axis=1, bitorder='little')
+    skip = low - start - first_byte * 8
+    return bits[:, skip:skip + high - low], low - first_day
+
+
+def _day_counts(start, matrix, first_day, days):
+    """Completed items on each of `days` days from `first_day`"""
+    counts = np.zeros(days, dtype=np.int64)
+    bits, offset = _bits(start, matrix, first_day, days)
+    if bits is not None:
+        counts[offset:offset + bits.shape[1]] = bits.sum(axis=0)
+    return counts
+
+
+def totals(first, last):
+    """{routine_item_id: days completed} between two dates, on any day of the week"""
+    first_day, days = day_number(first), (last - first).days + 1
+    counts = {}
+    for start, matrix, item_ids in _matrices().values():
+        bits, _ = _bits(start, matrix, first_day, days)
+        if bits is not None:
+            counts.update(zip(item_ids, bits.sum(axis=1, dtype=np.int64).tolist()))
+    return counts
+
+
+def _series(completed, possible, **labels):
+    """Columns of completed, possible and score (a percentage, or None where nothing applied)"""
+    score = np.round(100 * completed / np.maximum(possible, 1), 1)
+    possible = possible.tolist()
+    return {
+        **labels,
+        'completed': completed.tolist(),
+        'possible': possible,
+        'score': [s if p else None for s, p in zip(score.tolist(), possible)],
+    }
+
+
+def _grouped(keys, completed, possible):
+    """Sums over runs of days with the same key (week or month), and the index of each run's first day"""
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    return starts, np.add.reduceat(completed, starts), np.add.reduceat(possible, starts)
+
+
+def scores(first, last, routine_type=None):
+    """Daily, weekly (Monday-based) and monthly completion for the days first..last.
+
+    Each series is a set of parallel columns; `daily` runs from `first`
+    one day per entry. Weeks and months at the ends of the range only count
+    the days inside it.
+    """
+    first_day, days = day_number(first), (last - first).days + 1
+    numbers = np.arange(first_day, first_day + days)
+    weekend = weekends(numbers)
+    completed = np.zeros(days, dtype=np.int64)
+    possible = np.zeros(days, dtype=np.int64)
+    for item_type, (start, matrix, _) in _matrices().items():
+        if routine_type and item_type != routine_type:
+            continue
+        scheduled = applies(item_type, weekend)
+        completed += np.where(scheduled, _day_counts(start, matrix, first_day, days), 0)
+        possible += np.where(scheduled, matrix.shape[0], 0)
+
+    # Only the first day of each group is turned into a label
+    dates = numbers.astype('datetime64[D]')
+    week_starts, week_completed, week_possible = _grouped(numbers - weekdays(numbers), completed, possible)
+    months = dates.astype('datetime64[M]')
+    month_starts, month_completed, month_possible = _grouped(months, completed, possible)
+    return {
+        'from': first.isoformat(),
+        'to': last.isoformat(),
+        'routine_type': routine_type,
+        'daily': _series(completed, possible),
+        'weekly': _series(week_completed, week_possible, start=np.datetime_as_string(dates[week_starts]).tolist()),
+        'monthly': _series(month_completed, month_possible, month=np.datetime_as_string(months[month_starts]).tolist()),
+    }
@@ -0,0 +1,96 @@
+"""SQLite settings for serving from several worker processes at once.
+
+Every new connection is switched to WAL journaling, so readers never block
+the writer and the writer never blocks readers. It also gets
+synchronous=NORMAL, which is durable in WAL mode without an fsync per
+commit, a busy timeout so a writer waits its turn instead of failing, and
+a larger page cache. Connections are pooled per process.
+
+A writer can still give up if the lock is held for longer than the busy
+timeout. Write routes are wrapped in `retry_on_lock`, which rolls back and
+runs the whole handler again with jittered exponential backoff. A write
+that is still locked out after its last retry gets a 503, so clients and
+load tests can tell contention from a crash.
+"""
+import random
+import sqlite3
+import time
+from functools import wraps
+from flask import current_app, request, jsonify
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from models import db
+
+_pragmas = {} # Applied to every new SQLite connection; empty when tuning is off
+
+
+def init_app(app):
+    """Fill in engine options and pragmas; must run before db.init_app(app)"""
+    app.config.setdefault('SQLITE_TUNING', True)
+    app.config.setdefault('SQLITE_BUSY_TIMEOUT', 5000)  # ms a writer waits for the lock
+    app.config.setdefault('SQLITE_CACHE_SIZE', 20000)   # KiB of page cache per connection
+    app.config.setdefault('DB_POOL_SIZE', 10)
+    app.config.setdefault('DB_MAX_OVERFLOW', 10)
+    app.config.setdefault('DB_WRITE_RETRIES', 5)
+    app.register_error_handler(OperationalError, _database_error)
+    if not app.config['SQLITE_TUNING']:
+        return
+
+    uri = app.config['SQLALCHEMY_DATABASE_URI']
+    if uri.startswith('sqlite') and ':memory:' not in uri and uri.rstrip('/') != 'sqlite:':
+        options = app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+        options.setdefault('pool_size', app.config['DB_POOL_SIZE'])
+        options.setdefault('max_overflow', app.config['DB_MAX_OVERFLOW'])
+        options.setdefault('connect_args', {}).setdefault('timeout', app.config['SQLITE_BUSY_TIMEOUT'] / 1000)
+
+    _pragmas.update({
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': app.config['SQLITE_BUSY_TIMEOUT'],
+        'cache_size': -app.config['SQLITE_CACHE_SIZE'], # Negative means KiB rather than pages
+    })
+
+
+@event.listens_for(Engine, 'connect')
+def _set_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in _pragmas.items():
+        cursor.execute(f'PRAGMA {name}={value}')
+    cursor.close()
+
+
+def is_lock_error(error):
+    message = str(getattr(error, 'orig', error)).lower()
+    return 'database is locked' in message or 'database is busy' in message
+
+
+def _database_error(error):
+    if not is_lock_error(error):
+        raise error
+    response = jsonify({'success': False, 'error': 'The database is busy, try again'})
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
+
+
+def retry_on_lock(view):
+    """Re-run a write handler from the top when SQLite reports the database locked"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        retries = current_app.config['DB_WRITE_RETRIES'] if current_app.config['SQLITE_TUNING'] else 0
+        for attempt in range(retries + 1):
+            try:
+                return view(*args, **kwargs)
+            except OperationalError as e:
+                db.session.rollback()
+                if attempt == retries or not is_lock_error(e):
+                    raise
+                current_app.logger.warning("Database locked in %s, retry %d of %d", request.endpoint, attempt + 1, retries)
+                for _, upload in request.files.items(multi=True):
+                    if not upload.stream.closed:
+                        upload.stream.seek(0) # Let the retry save the same files again
+                time.sleep(random.uniform(0.5, 1.0) * 0.05 * 2 ** attempt)
+    return wrapper
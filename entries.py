@@ -0,0 +1,60 @@
+"""In-process LRU of diary entry details for the gallery lightbox.
+
+Gallery tiles only carry an entry id, and the lightbox fetches the entry's
+text when it opens. Browsing a gallery opens the same few entries over and
+over, so the details are kept here, up to CACHE_SIZE of them, each with the
+`diary_entries` data version it was read at (see versions.py). A hit is
+only served while that version is current, so an edit made through any
+worker process, an import or a restore is seen on the next open. Diary
+writes also call `invalidate()` to free the entry sooner. With SHARDING on,
+entries are kept per user.
+"""
+from collections import OrderedDict
+from threading import Lock
+from models import db, DiaryEntry
+import shards
+import versions
+
+CACHE_SIZE = 256
+
+_lock = Lock()
+_details = OrderedDict() # (shard, entry id) -> (data version, detail dict), least recently used first
+
+
+def get(entry_id):
+    """The entry's date, text and pinned note as a dict, or None if there is no such entry"""
+    key = (shards.current(), entry_id)
+    # Read before loading, so a write that lands during the load only makes the next open reload
+    version, _ = versions.current(['diary_entries'])
+    with _lock:
+        cached = _details.get(key)
+        if cached is not None and cached[0] == version:
+            _details.move_to_end(key)
+            return cached[1]
+
+    entry = db.session.get(DiaryEntry, entry_id)
+    if entry is None:
+        return None
+    detail = {
+        'id': entry.id,
+        'date': entry.date.isoformat(),
+        'date_label': entry.date.strftime('%B %d, %Y'),
+        'content': entry.content or '',
+        'pinned_text': entry.pinned_text or '',
+        'version': entry.version,
+    }
+    with _lock:
+        _details[key] = (version, detail)
+        _details.move_to_end(key)
+        while len(_details) > CACHE_SIZE:
+            _details.popitem(last=False)
+    return detail
+
+
+def invalidate(entry_id=None):
+    """Forget one entry of the active user, or everything when no id is given"""
+    with _lock:
+        if entry_id is None:
+            _details.clear()
+        else:
+            _details.pop((shards.current(), entry_id), None)
@@ -0,0 +1,152 @@
+"""Generate a synthetic journal of any size for benchmarking.
+
+Writes years of routine logs, diary entries, photos and reminders into a
+separate SQLite file (never your real habit_tracker.db) using bulk inserts:
+
+    python generate_data.py --years 5 --routines 20 --fill-rate 0.7 --photos-per-day 3 --database instance/bench_5y.db
+"""
+import argparse
+import os
+import random
+from datetime import date, timedelta
+from sqlalchemy import insert
+from models import (db, RoutineItem, TrackerLog, DiaryEntry, DiaryImage, DiaryImageVariant,
+                    Reminder, UserSetting, format_minute)
+import migrations
+import rollups
+
+WORDS = (
+    "today felt calm focused tired strong slow early late gym walk work call family "
+    "study read cooked breakfast lunch dinner meditation archana sleep water coffee "
+    "rain sun park friends project meeting deadline progress grateful reset energy "
+    "headache recovery weights run stretch journal plan idea music quiet busy"
+).split()
+CATEGORIES = ['Health', 'Work', 'Spirit', 'Learning', 'Home', None]
+MOODS = ['Happy', 'Calm', 'Tired', 'Stressed', 'Motivated', None]
+BATCH_SIZE = 10000
+
+
+def _insert(session, model, rows):
+    for i in range(0, len(rows), BATCH_SIZE):
+        session.execute(insert(model), rows[i:i + BATCH_SIZE])
+
+
+def _sentence(rng, length):
+    return ' '.join(rng.choice(WORDS) for _ in range(length)).capitalize() + '.'
+
+
+def generate(years=1, routines=20, fill_rate=0.7, diary_rate=0.8, photos_per_day=1.0, seed=42, end_date=None,
+             reminder_rules=0):
+    """Fill the app's freshly created database; returns row counts per table"""
+    rng = random.Random(seed)
+    end_date = end_date or date.today()
+    days = [end_date - timedelta(days=i) for i in range(int(years * 365))][::-1]
+
+    migrations.upgrade()
+
+    # Routines: `routines` items per day type, spread from 06:00 at 45 minute steps
+    items = []
+    for routine_type in ('Weekday', 'Weekend'):
+        for n in range(routines):
+            items.append({
+                'name': f"{routine_type} routine {n + 1}",
+                'time_start': format_minute((6 * 60 + n * 45) % (24 * 60)),
+                'start_minute': (6 * 60 + n * 45) % (24 * 60),
+                'routine_type': routine_type,
+                'category': CATEGORIES[n % len(CATEGORIES)],
+                'description': _sentence(rng, 6),
+            })
+    _insert(db.session, RoutineItem, items)
+    ids_by_type = {'Weekday': [], 'Weekend': []}
+    for item in RoutineItem.query.all():
+        ids_by_type[item.routine_type].append(item.id)
+
+    logs, entries, reminders = [], [], []
+    for day in days:
+        for item_id in ids_by_type['Weekend' if day.weekday() >= 5 else 'Weekday']:
+            roll = rng.random()
+            if roll < fill_rate:
+                logs.append({'date': day, 'routine_item_id': item_id, 'status': True})
+            elif roll < fill_rate + 0.05:
+                logs.append({'date': day, 'routine_item_id': item_id, 'status': False}) # Toggled back off
+        if rng.random() < diary_rate:
+            entries.append({
+                'date': day,
+                'content': '\n\n'.join(_sentence(rng, rng.randint(20, 80)) for _ in range(rng.randint(1, 4))),
+                'pinned_text': _sentence(rng, 5) if rng.random() < 0.3 else '',
+                'mood': rng.choice(MOODS),
+            })
+        if rng.random() < 0.1:
+            reminders.append({'date': day, 'message': _sentence(rng, 4)})
+    rules = []
+    for _ in range(reminder_rules):
+        rules.append({
+            'date': rng.choice(days),
+            'message': _sentence(rng, 4),
+            'time': f"{rng.randrange(24):02d}:{rng.randrange(0, 60, 5):02d}",
+            'recurrence': rng.choice(['daily', 'weekdays', 'weekends', 'weekly', 'monthly']),
+        })
+    _insert(db.session, TrackerLog, logs)
+    _insert(db.session, DiaryEntry, entries)
+    _insert(db.session, Reminder, reminders)
+    _insert(db.session, Reminder, rules)
+
+    # Photos hang off entries, so they need the generated ids
+    images = []
+    for entry_id, entry_date in db.session.query(DiaryEntry.id, DiaryEntry.date):
+        count = int(photos_per_day) + (rng.random() < photos_per_day % 1)
+        for n in range(count):
+            images.append({'diary_entry_id': entry_id, 'image_path': f"{entry_date}_{n}_synthetic.jpg"})
+    _insert(db.session, DiaryImage, images)
+
+    variants = []
+    for image_id, image_path in db.session.query(DiaryImage.id, DiaryImage.image_path):
+        stem = os.path.splitext(image_path)[0]
+        for kind, (width, height) in (('thumb', (320, 240)), ('modal', (1280, 960))):
+            for fmt, ext in (('jpeg', 'jpg'), ('webp', 'webp')):
+                variants.append({
+                    'diary_image_id': image_id, 'kind': kind, 'format': fmt,
+                    'width': width, 'height': height, 'image_path': f"{stem}.{kind}.{ext}",
+                })
+    _insert(db.session, DiaryImageVariant, variants)
+
+    db.session.add(UserSetting(key='target_score', value='80'))
+    db.session.commit()
+    rollups.rebuild()
+
+    return {
+        'days': len(days),
+        'routine_items': len(items),
+        'tracker_logs': len(logs),
+        'diary_entries': len(entries),
+        'diary_images': len(images),
+        'reminders': len(reminders) + len(rules),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', required=True, help="SQLite file to create (replaced if it exists)")
+    parser.add_argument('--years', type=float, default=1)
+    parser.add_argument('--routines', type=int, default=20, help="Items per day type")
+    parser.add_argument('--fill-rate', type=float, default=0.7, help="Share of items completed each day")
+    parser.add_argument('--diary-rate', type=float, default=0.8, help="Share of days with an entry")
+    parser.add_argument('--photos-per-day', type=float, default=1.0, help="Average photos per entry")
+    parser.add_argument('--reminder-rules', type=int, default=0, help="Recurring timed reminders to add")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    if os.path.exists(args.database):
+        os.remove(args.database)
+    # The app binds its engine at import time, so point it at the target first
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.abspath(args.database)
+    from app import app
+
+    with app.app_context():
+        counts = generate(args.years, args.routines, args.fill_rate, args.diary_rate, args.photos_per_day, args.seed,
+                          reminder_rules=args.reminder_rules)
+    print(f"Generated {args.database}: " + ', '.join(f"{k}={v}" for k, v in counts.items()))
+
+
+if __name__ == "__main__":
+    main()
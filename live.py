@@ -0,0 +1,351 @@
+"""Live page updates over server-sent events.
+
+Writes publish small diffs on the notification channel: a habit's new
+status with the day's score, a changed pinned note, a new reminder, a
+reminder coming due. Open pages receive them through an EventSource and
+patch themselves in place, so a phone and a desktop showing the same day
+stay in step without reloading.
+
+A WSGI server ties a worker thread to every response for as long as it
+streams, so the streams are not served by Flask. One hub thread owns them
+all instead. It listens on LIVE_PORT and answers `GET /events` with the
+event-stream headers. After that the socket sits in a selector and is only
+touched when an event or a keep-alive comment goes out, so hundreds of
+idle pages cost a socket and a small buffer each. A client that stops
+reading is dropped once LIVE_BUFFER bytes are waiting for it; EventSource
+reconnects by itself.
+
+With SHARDING on, a stream belongs to the user whose session cookie
+opened it. Like the reminder scheduler, the hub lives in the process that
+serves requests. Under several worker processes the first one to bind
+LIVE_PORT runs the hub, and every other worker forwards its events to it
+as datagrams on 127.0.0.1:LIVE_PORT, signed with the app's SECRET_KEY, so
+pages hear about writes whichever worker served them.
+"""
+import json
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+from urllib.parse import urlsplit
+from flask import current_app, g
+from itsdangerous import BadData, BadSignature, URLSafeSerializer
+from werkzeug.http import parse_cookie
+from models import db, User
+import notifications
+import shards
+
+HEARTBEAT = 25 # Seconds between keep-alive comments, inside common proxy idle timeouts
+MAX_REQUEST = 16 * 1024
+MAX_DATAGRAM = 64 * 1024
+
+_hub = None
+_lock = threading.Lock()
+
+
+def init_app(app):
+    app.config.setdefault('LIVE_UPDATES', True)
+    app.config.setdefault('LIVE_HOST', '0.0.0.0')
+    app.config.setdefault('LIVE_PORT', 5001)
+    app.config.setdefault('LIVE_URL', None) # Where browsers connect, when a proxy serves the hub elsewhere
+    app.config.setdefault('LIVE_BUFFER', 64 * 1024) # Unsent bytes a client may fall behind by
+    app.add_template_global(live_stream)
+
+    @app.before_request
+    def start_hub():
+        # Started by the first request, like the reminder scheduler
+        if app.config['LIVE_UPDATES'] and _hub is None:
+            get_hub(app)
+
+
+def get_hub(app):
+    """The running hub, a Forwarder to another process's hub, or False if neither could start"""
+    global _hub
+    with _lock:
+        if _hub is None:
+            try:
+                _hub = Hub(app)
+            except OSError as e:
+                # Most likely another worker of this app holds the port; hand it our events
+                app.logger.info("Live updates go through another process on port %s: %s", app.config['LIVE_PORT'], e)
+                try:
+                    _hub = Forwarder(app)
+                except OSError as e:
+                    app.logger.warning("Live updates are off in this process: %s", e)
+                    _hub = False
+    return _hub
+
+
+def _serializer(app):
+    return URLSafeSerializer(app.secret_key, salt='live-updates')
+
+
+def active():
+    """Whether this process streams updates, so publishers can skip building them"""
+    return bool(_hub)
+
+
+def publish(kind, data):
+    if _hub:
+        notifications.publish(kind, data, shards.current())
+
+
+def live_stream():
+    """Where pages open their EventSource: {url} or {port} on the page's own host; None for no stream.
+
+    The host is left to the browser because rendered pages are cached and
+    shared between everyone who reaches the app, by whatever name.
+    """
+    if not _hub or (current_app.config['SHARDING'] and g.get('user') is None):
+        return None
+    return {'url': current_app.config['LIVE_URL'], 'port': _hub.port}
+
+
+def _message(event):
+    data = json.dumps(event['data'], separators=(',', ':'))
+    return f"id: {event['id']}\nevent: {event['kind']}\ndata: {data}\n\n".encode()
+
+
+def _head(status, origin, stream=False):
+    lines = [f'HTTP/1.1 {status}']
+    if stream:
+        lines += ['Content-Type: text/event-stream', 'Cache-Control: no-cache', 'X-Accel-Buffering: no']
+    else:
+        lines += ['Content-Length: 0', 'Connection: close']
+    if origin:
+        # The page is served from another port, so the stream is a credentialed cross-origin request
+        lines += [f'Access-Control-Allow-Origin: {origin}', 'Access-Control-Allow-Credentials: true', 'Vary: Origin']
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+class _Client:
+    def __init__(self, sock):
+        self.sock = sock
+        self.request = b''
+        self.outbox = bytearray()
+        self.shard = None
+        self.streaming = False
+        self.writing = False  # Registered for EVENT_WRITE while the outbox has data
+        self.closing = False  # Close once the outbox is sent (error replies)
+        self.closed = False
+
+
+class Forwarder:
+    """Sends this process's events to the hub another worker runs"""
+
+    def __init__(self, app):
+        self.port = app.config['LIVE_PORT']
+        self._serializer = _serializer(app)
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.setblocking(False)
+        notifications.listen(self._published)
+
+    def _published(self, event, shard):
+        try:
+            self._sock.sendto(self._serializer.dumps([event, shard]).encode(), ('127.0.0.1', self.port))
+        except OSError:
+            pass # No hub listening or the buffer is full; like a dropped stream, pages catch up on reload
+
+
+class Hub:
+    """One thread serving every event stream from a selector"""
+
+    def __init__(self, app):
+        self.app = app
+        self.buffer_limit = app.config['LIVE_BUFFER']
+        self._listener = socket.create_server((app.config['LIVE_HOST'], app.config['LIVE_PORT']), backlog=128)
+        self._listener.setblocking(False)
+        self.port = self._listener.getsockname()[1]
+        # Events forwarded by the other worker processes
+        self._serializer = _serializer(app)
+        self._inbox = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self._inbox.bind(('127.0.0.1', self.port))
+        except OSError:
+            self._inbox.close()
+            self._listener.close()
+            raise
+        self._inbox.setblocking(False)
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._listener, selectors.EVENT_READ)
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+        self._selector.register(self._inbox, selectors.EVENT_READ)
+        self._pending = deque() # (event, shard) published since the loop last ran
+        self._clients = {}      # socket -> _Client
+        notifications.listen(self._published)
+        threading.Thread(target=self._run, name='live-updates', daemon=True).start()
+
+    def client_count(self):
+        return sum(client.streaming for client in list(self._clients.values()))
+
+    def _published(self, event, shard):
+        # Runs in the publishing thread: hand over and poke the loop
+        self._pending.append((event, shard))
+        try:
+            self._wake_w.send(b'\0')
+        except BlockingIOError:
+            pass # The loop has wake-ups waiting already
+
+    def _run(self):
+        next_beat = time.monotonic() + HEARTBEAT
+        while True:
+            for key, mask in self._selector.select(max(0, next_beat - time.monotonic())):
+                if key.fileobj is self._listener:
+                    self._accept()
+                elif key.fileobj is self._wake_r:
+                    self._dispatch()
+                elif key.fileobj is self._inbox:
+                    self._receive()
+                else:
+                    self._service(key.data, mask)
+            if time.monotonic() >= next_beat:
+                self._broadcast(b': keep-alive\n\n', lambda client: True)
+                next_beat = time.monotonic() + HEARTBEAT
+
+    def _accept(self):
+        try:
+            sock, _ = self._listener.accept()
+        except OSError:
+            return
+        sock.setblocking(False)
+        client = _Client(sock)
+        self._clients[sock] = client
+        self._selector.register(sock, selectors.EVENT_READ, client)
+
+    def _service(self, client, mask):
+        if client.closed:
+            return
+        try:
+            if mask & selectors.EVENT_READ:
+                self._read(client)
+            if mask & selectors.EVENT_WRITE and not client.closed:
+                self._flush(client)
+        except Exception:
+            self.app.logger.exception("Live update stream failed")
+            self._drop(client)
+
+    def _read(self, client):
+        try:
+            data = client.sock.recv(4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self._drop(client) # The page went away
+        elif not client.streaming and not client.closing:
+            client.request += data
+            if b'\r\n\r\n' in client.request:
+                self._open(client)
+            elif len(client.request) > MAX_REQUEST:
+                self._drop(client)
+
+    def _open(self, client):
+        head = client.request.split(b'\r\n\r\n', 1)[0].decode('latin-1')
+        request_line, *header_lines = head.split('\r\n')
+        headers = {}
+        for line in header_lines:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        method, target = (request_line.split(' ') + ['', ''])[:2]
+        origin = headers.get('origin')
+
+        if method != 'GET' or urlsplit(target).path != '/events':
+            return self._reply(client, '404 Not Found', None)
+        # Only pages from this host may read the stream with the visitor's cookie
+        if origin and urlsplit(origin).hostname != urlsplit('//' + headers.get('host', '')).hostname:
+            return self._reply(client, '403 Forbidden', None)
+        try:
+            client.shard = self._shard_for(headers.get('cookie', ''))
+        except PermissionError:
+            return self._reply(client, '401 Unauthorized', origin)
+        client.streaming = True
+        client.request = b''
+        self._send(client, _head('200 OK', origin, stream=True) + b'retry: 3000\n\n')
+
+    def _shard_for(self, cookie_header):
+        """The shard of the user signed in with this session cookie; None in single-user mode"""
+        if not self.app.config['SHARDING']:
+            return None
+        serializer = self.app.session_interface.get_signing_serializer(self.app)
+        try:
+            value = parse_cookie(cookie_header)[self.app.config['SESSION_COOKIE_NAME']]
+            session = serializer.loads(value, max_age=int(self.app.permanent_session_lifetime.total_seconds()))
+        except (KeyError, BadSignature):
+            raise PermissionError
+        user_id = session.get('user_id')
+        with self.app.app_context():
+            user = db.session.get(User, user_id) if user_id else None
+            if user is None:
+                raise PermissionError
+            return user.shard
+
+    def _reply(self, client, status, origin):
+        client.closing = True
+        self._send(client, _head(status, origin))
+
+    def _dispatch(self):
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self._pending:
+            event, shard = self._pending.popleft()
+            self._broadcast(_message(event), lambda client: client.shard == shard)
+
+    def _receive(self):
+        while True:
+            try:
+                datagram = self._inbox.recv(MAX_DATAGRAM)
+            except BlockingIOError:
+                return
+            except OSError:
+                continue
+            try:
+                event, shard = self._serializer.loads(datagram.decode())
+            except (BadData, UnicodeDecodeError, TypeError, ValueError):
+                continue # Not from a worker of this app
+            shard = shards.Shard(*shard) if shard else None
+            self._broadcast(_message(event), lambda client: client.shard == shard)
+
+    def _broadcast(self, message, wanted):
+        for client in list(self._clients.values()):
+            if client.streaming and not client.closed and wanted(client):
+                self._send(client, message)
+
+    def _send(self, client, data):
+        client.outbox += data
+        if len(client.outbox) > self.buffer_limit:
+            return self._drop(client) # Not reading; it reconnects and starts afresh
+        self._flush(client)
+
+    def _flush(self, client):
+        try:
+            sent = client.sock.send(client.outbox)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            return self._drop(client)
+        del client.outbox[:sent]
+        if client.closing and not client.outbox:
+            return self._drop(client)
+        if client.writing != bool(client.outbox):
+            client.writing = bool(client.outbox)
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if client.writing else 0)
+            self._selector.modify(client.sock, events, client)
+
+    def _drop(self, client):
+        if client.closed:
+            return
+        client.closed = True
+        self._clients.pop(client.sock, None)
+        try:
+            self._selector.unregister(client.sock)
+        except (KeyError, ValueError):
+            pass
+        client.sock.close()
@@ -0,0 +1,379 @@
+"""Load test: simulated users against a locally launched multi-worker server.
+
+A generated journal (see generate_data.py) is served by N worker
+processes sharing one listening socket, each running the app under
+Werkzeug's threaded server. An asyncio client then runs --users virtual
+users, each with its own keep-alive connection, until --duration is up.
+Every user follows one scenario, picked by the profile's weights:
+
+  autosave  an open diary page saving a patch every second, as diary.html does
+  toggles   the dashboard ticking habits through the batch API and prefetching days, as index.html does
+  browse    moving between the dashboard, gallery, timeline and analytics pages
+
+The report gives requests per second, p50/p95/p99 latency and error, lock
+(503) and edit-conflict (409) rates for every endpoint, so capacity changes
+can be compared run to run:
+
+    python loadtest.py --workers 1 2 4 --users 50 --duration 30
+    python loadtest.py --profile writers --think 0 --output bench/load.json
+    python loadtest.py --url http://127.0.0.1:5000 --profile browse   # a server that's already running
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import random
+import re
+import socket
+import tempfile
+import time
+from collections import defaultdict
+from datetime import date, timedelta
+from urllib.parse import urlsplit
+from benchmark import percentile
+
+# Share of virtual users running each scenario
+PROFILES = {
+    'daily': {'autosave': 2, 'toggles': 5, 'browse': 3},
+    'writers': {'autosave': 5, 'toggles': 5, 'browse': 0},
+    'browse': {'autosave': 0, 'toggles': 0, 'browse': 1},
+}
+
+# (weight, label, path) of the pages a browsing user moves between
+PAGES = [
+    (4, 'GET /', '/'),
+    (3, 'GET /gallery', '/gallery'),
+    (2, 'GET /timeline', '/timeline'),
+    (1, 'GET /analytics', '/analytics'),
+    (1, 'GET /api/streaks', '/api/streaks'),
+    (1, 'GET /api/scores', '/api/scores'),
+    (1, 'GET /timetable', '/timetable'),
+]
+
+HISTORY_DAYS = 14        # Users work on days this far back, so some of them share a day
+REQUEST_TIMEOUT = 30     # Seconds before a request counts as an error
+WORDS = ['walked', 'read', 'slept', 'early', 'coffee', 'gym', 'quiet', 'busy', 'day', 'notes']
+
+
+class Connection:
+    """One keep-alive HTTP/1.1 connection, as a browser tab would hold"""
+
+    def __init__(self, host, port):
+        self.host, self.port = host, port
+        self.reader = self.writer = None
+
+    async def request(self, method, path, body=None):
+        """(status, body bytes); a JSON body is sent for any non-None `body`"""
+        if self.writer is not None:
+            try:
+                return await self._exchange(method, path, body)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self.close() # The server dropped the idle connection; retry on a fresh one
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        return await self._exchange(method, path, body)
+
+    async def _exchange(self, method, path, body):
+        payload = json.dumps(body).encode() if body is not None else b''
+        head = f'{method} {path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\nContent-Length: {len(payload)}\r\n'
+        if body is not None:
+            head += 'Content-Type: application/json\r\n'
+        self.writer.write(head.encode('latin-1') + b'\r\n' + payload)
+        await self.writer.drain()
+
+        status_line = await self.reader.readuntil(b'\r\n')
+        headers = {}
+        while (line := await self.reader.readuntil(b'\r\n')) != b'\r\n':
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if 'content-length' in headers:
+            data = await self.reader.readexactly(int(headers['content-length']))
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            data = b''
+            while size := int((await self.reader.readuntil(b'\r\n')).split(b';')[0], 16):
+                data += await self.reader.readexactly(size)
+                await self.reader.readexactly(2)
+            await self.reader.readuntil(b'\r\n')
+        else:
+            data = await self.reader.read()
+            headers['connection'] = 'close'
+        if headers.get('connection', '').lower() == 'close' or status_line.startswith(b'HTTP/1.0'):
+            self.close()
+        return int(status_line.split()[1]), data
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+class Stats:
+    """Latencies and outcomes per endpoint label"""
+
+    def __init__(self):
+        self.endpoints = defaultdict(lambda: {'latencies': [], 'ok': 0, 'errors': 0, 'locked': 0, 'conflicts': 0})
+
+    def add(self, label, ms, status):
+        endpoint = self.endpoints[label]
+        endpoint['latencies'].append(ms)
+        if status is None or (status >= 400 and status not in (409, 503)):
+            endpoint['errors'] += 1
+        elif status == 503:
+            endpoint['locked'] += 1
+        elif status == 409:
+            endpoint['conflicts'] += 1 # The diary's optimistic-concurrency answer, not a failure
+        else:
+            endpoint['ok'] += 1
+
+    def summary(self, elapsed):
+        rows = {}
+        everything = {'latencies': [], 'ok': 0, 'errors': 0, 'locked': 0, 'conflicts': 0}
+        for label, endpoint in sorted(self.endpoints.items()) + [('total', everything)]:
+            if label != 'total':
+                for key, value in endpoint.items():
+                    everything[key] += value
+            count = len(endpoint['latencies'])
+            if not count:
+                continue
+            rows[label] = {
+                'requests': count,
+                'per_second': round(count / elapsed, 1),
+                'p50_ms': round(percentile(endpoint['latencies'], 50), 1),
+                'p95_ms': round(percentile(endpoint['latencies'], 95), 1),
+                'p99_ms': round(percentile(endpoint['latencies'], 99), 1),
+                'error_rate': round(endpoint['errors'] / count, 4),
+                'lock_rate': round(endpoint['locked'] / count, 4),
+                'conflict_rate': round(endpoint['conflicts'] / count, 4),
+            }
+        return rows
+
+
+class User:
+    """One virtual user: a connection, a random stream and the shared stats"""
+
+    def __init__(self, number, host, port, stats, deadline, think, seed):
+        self.id = f'load-{number}'
+        self.connection = Connection(host, port)
+        self.stats = stats
+        self.deadline = deadline
+        self.think = think
+        self.rng = random.Random(seed)
+
+    def running(self):
+        return asyncio.get_running_loop().time() < self.deadline
+
+    async def pause(self, seconds):
+        """Think time around `seconds`, scaled by --think; 0 sends the next request at once"""
+        if self.think:
+            delay = self.rng.expovariate(1 / (seconds * self.think))
+            await asyncio.sleep(min(delay, max(0, self.deadline - asyncio.get_running_loop().time())))
+
+    def day(self):
+        return (date.today() - timedelta(days=self.rng.randrange(HISTORY_DAYS))).isoformat()
+
+    async def call(self, label, method, path, body=None):
+        """(status, body) of one timed request; status is None if it failed outright"""
+        started = time.perf_counter()
+        try:
+            status, data = await asyncio.wait_for(self.connection.request(method, path, body), REQUEST_TIMEOUT)
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ValueError):
+            self.connection.close()
+            status, data = None, b''
+        self.stats.add(label, (time.perf_counter() - started) * 1000, status)
+        return status, data
+
+
+def _json(data):
+    try:
+        return json.loads(data)
+    except ValueError:
+        return {}
+
+
+async def autosave(user):
+    """Open a day's diary, then keep typing; each pause is diary.html's one-second debounce"""
+    day = user.day()
+    _, page = await user.call('GET /diary', 'GET', f'/diary?date={day}')
+    match = re.search(rb'let version = (\d+);', page)
+    version = int(match.group(1)) if match else 0
+    while user.running():
+        await user.pause(1.0)
+        # Typing at the start of the text keeps the splice valid without tracking its length
+        word = user.rng.choice(WORDS) + ' '
+        status, data = await user.call('POST /diary/save', 'POST', '/diary/save', {
+            'date': day, 'base_version': version, 'patches': {'content': {'start': 0, 'end': 0, 'text': word}},
+        })
+        if status in (200, 409):
+            version = _json(data).get('version', version) # On a conflict, rebase onto the server's version
+
+
+async def toggles(user):
+    """The dashboard: tick a few habits at a time through the batch API, now and then switching day"""
+    day = user.day()
+    await user.call('GET /', 'GET', f'/?date={day}')
+    item_ids = []
+    while user.running():
+        if not item_ids or user.rng.random() < 0.1:
+            day = user.day()
+            _, data = await user.call('GET /api/day/<date>', 'GET', f'/api/day/{day}')
+            item_ids = [item['id'] for item in _json(data).get('items', [])]
+            if not item_ids:
+                await user.pause(2.0)
+                continue
+        await user.pause(2.0)
+        ops = [{'item_id': user.rng.choice(item_ids), 'date': day, 'status': user.rng.random() < 0.7}
+               for _ in range(user.rng.randint(1, 3))]
+        await user.call('POST /api/habits/batch', 'POST', '/api/habits/batch', {'ops': ops, 'client': user.id})
+
+
+async def browse(user):
+    """Move between read-only pages, sometimes scrolling the gallery a page further"""
+    weights, labels, paths = zip(*PAGES)
+    cursor = None
+    while user.running():
+        label, path = user.rng.choices(list(zip(labels, paths)), weights)[0]
+        if path == '/gallery' and cursor and user.rng.random() < 0.5:
+            _, data = await user.call('GET /api/gallery', 'GET', f'/api/gallery?cursor={cursor}')
+            cursor = _json(data).get('next_cursor')
+        else:
+            _, data = await user.call(label, 'GET', path)
+            if path == '/gallery':
+                match = re.search(rb'data-next-cursor="([^"]*)"', data)
+                cursor = match.group(1).decode() if match else None
+        await user.pause(3.0)
+
+
+SCENARIOS = {'autosave': autosave, 'toggles': toggles, 'browse': browse}
+
+
+async def _wait_until_up(host, port, timeout=60):
+    deadline = time.monotonic() + timeout
+    while True:
+        connection = Connection(host, port)
+        try:
+            status, _ = await connection.request('GET', f'/api/day/{date.today().isoformat()}')
+            if status == 200:
+                return
+        except OSError:
+            pass
+        finally:
+            connection.close()
+        if time.monotonic() > deadline:
+            raise SystemExit(f"No server answering on {host}:{port}")
+        await asyncio.sleep(0.2)
+
+
+async def _run_user(user, scenario):
+    await asyncio.sleep(user.rng.uniform(0, 1)) # Stagger the arrivals
+    try:
+        await scenario(user)
+    finally:
+        user.connection.close()
+
+
+async def load(host, port, profile, users, duration, think, seed):
+    """Run the virtual users against a server until `duration` is up; returns per-endpoint stats"""
+    await _wait_until_up(host, port)
+    loop = asyncio.get_running_loop()
+    stats = Stats()
+    started = loop.time()
+    rng = random.Random(seed)
+    names = [name for name, weight in PROFILES[profile].items() if weight]
+    weights = [PROFILES[profile][name] for name in names]
+    tasks = [
+        asyncio.create_task(_run_user(User(n, host, port, stats, started + duration, think, seed + n),
+                                      SCENARIOS[rng.choices(names, weights)[0]]))
+        for n in range(users)
+    ]
+    await asyncio.gather(*tasks)
+    return stats.summary(loop.time() - started)
+
+
+def prepare(database, years):
+    """Create the journal the server runs against. Runs in a child process."""
+    os.environ['DATABASE_URL'] = 'sqlite:///' + database
+    from app import app
+    from generate_data import generate
+    with app.app_context():
+        generate(years=years, routines=10)
+
+
+def serve(database, listener):
+    """Serve the app on the shared listening socket until terminated. Runs in a child process."""
+    os.environ['DATABASE_URL'] = 'sqlite:///' + database
+    os.environ['LIVE_UPDATES'] = '0'       # Workers would race for LIVE_PORT
+    os.environ['REMINDER_SCHEDULER'] = '0'
+    from werkzeug.serving import make_server
+    from app import app
+    logging.getLogger('werkzeug').setLevel(logging.ERROR) # No line per request
+    app.logger.setLevel(logging.ERROR)                    # Nor a warning per lock retry; 503s are counted
+    make_server('127.0.0.1', 0, app, threaded=True, fd=listener.fileno()).serve_forever()
+
+
+def run(workers, args, workdir):
+    """Start a fresh journal and `workers` server processes, load them, and stop them"""
+    context = multiprocessing.get_context('spawn')
+    database = os.path.join(workdir, f'load_{workers}.db')
+    with context.Pool(1) as pool:
+        pool.apply(prepare, (database, args.years))
+
+    listener = socket.create_server(('127.0.0.1', 0), backlog=1024)
+    processes = [context.Process(target=serve, args=(database, listener), daemon=True) for _ in range(workers)]
+    for process in processes:
+        process.start()
+    try:
+        return asyncio.run(load('127.0.0.1', listener.getsockname()[1], args.profile, args.users,
+                                args.duration, args.think, args.seed))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+        listener.close()
+
+
+def print_results(title, rows):
+    print(f"\n== {title} ==")
+    print(f"{'endpoint':<26}{'requests':>9}{'req/s':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+          f"{'errors':>8}{'locked':>8}{'409s':>7}")
+    for label, r in rows.items():
+        print(f"{label:<26}{r['requests']:>9}{r['per_second']:>8}{r['p50_ms']:>9}{r['p95_ms']:>9}{r['p99_ms']:>9}"
+              f"{r['error_rate']:>8.1%}{r['lock_rate']:>8.1%}{r['conflict_rate']:>7.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help="Server process counts to try")
+    parser.add_argument('--users', type=int, default=50, help="Concurrent virtual users")
+    parser.add_argument('--duration', type=float, default=30, help="Seconds per run")
+    parser.add_argument('--profile', choices=PROFILES, default='daily', help="Mix of user scenarios")
+    parser.add_argument('--think', type=float, default=1.0,
+                        help="Scale for the pauses between a user's requests; 0 for back-to-back requests")
+    parser.add_argument('--years', type=float, default=1, help="History in the generated journal")
+    parser.add_argument('--url', help="Load this running server instead of starting one")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="Write results JSON here")
+    args = parser.parse_args()
+
+    runs = []
+    if args.url:
+        url = urlsplit(args.url)
+        rows = asyncio.run(load(url.hostname, url.port or 80, args.profile, args.users, args.duration,
+                                args.think, args.seed))
+        runs.append({'url': args.url, 'endpoints': rows})
+        print_results(f"{args.url}, {args.users} users, {args.profile}", rows)
+    else:
+        with tempfile.TemporaryDirectory() as workdir:
+            for workers in args.workers:
+                rows = run(workers, args, workdir)
+                runs.append({'workers': workers, 'endpoints': rows})
+                print_results(f"{workers} worker(s), {args.users} users, {args.profile}", rows)
+
+    if args.output:
+        settings = {k: getattr(args, k) for k in ('users', 'duration', 'profile', 'think', 'years', 'seed')}
+        with open(args.output, 'w') as f:
+            json.dump({'settings': settings, 'runs': runs}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""Request and SQL instrumentation, exported in Prometheus text format.
+
+Every request is timed into a per-endpoint latency histogram, and
+SQLAlchemy cursor events count the queries it ran and the time they took.
+A request that runs the same statement shape more than
+`NPLUSONE_THRESHOLD` times is logged and counted as a likely N+1 pattern.
+With `SERVER_TIMING` enabled the per-request numbers are also sent in a
+Server-Timing header for the browser's network panel.
+
+The bookkeeping is a few counter updates per request and per query, cheap
+enough to leave on in production. Counts are per process.
+"""
+import re
+import time
+from collections import Counter, defaultdict
+from threading import Lock
+from flask import current_app, g, request, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Request latency buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Collapses expanded IN (...) lists so they count as one statement shape
+_IN_LIST = re.compile(r'\((?:\?, )+\?\)')
+
+_lock = Lock()
+_requests = Counter()                         # (endpoint, method, status) -> count
+_latency = defaultdict(lambda: [0] * len(BUCKETS))  # endpoint -> cumulative bucket counts
+_latency_sum = Counter()                      # endpoint -> seconds
+_latency_count = Counter()                    # endpoint -> requests
+_queries = Counter()                          # endpoint -> queries
+_query_seconds = Counter()                    # endpoint -> seconds in SQL
+_nplusone = Counter()                         # endpoint -> flagged requests
+
+
+def init_app(app):
+    app.config.setdefault('NPLUSONE_THRESHOLD', 10)
+    app.config.setdefault('SERVER_TIMING', False)
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+
+
+def _start_request():
+    g.metrics_started = time.perf_counter()
+    g.metrics_queries = 0
+    g.metrics_query_seconds = 0.0
+    g.metrics_shapes = Counter()
+
+
+def _finish_request(response):
+    started = g.pop('metrics_started', None)
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    endpoint = request.endpoint or 'unmatched'
+    queries = g.metrics_queries
+    query_seconds = g.metrics_query_seconds
+
+    threshold = current_app.config['NPLUSONE_THRESHOLD']
+    repeated = [(shape, n) for shape, n in g.metrics_shapes.items() if n > threshold]
+    for shape, n in repeated:
+        current_app.logger.warning("Possible N+1 in %s: statement ran %d times: %s", endpoint, n, shape[:200])
+
+    with _lock:
+        _requests[(endpoint, request.method, response.status_code)] += 1
+        buckets = _latency[endpoint]
+        for i, bound in enumerate(BUCKETS):
+            if elapsed <= bound:
+                buckets[i] += 1
+        _latency_sum[endpoint] += elapsed
+        _latency_count[endpoint] += 1
+        _queries[endpoint] += queries
+        _query_seconds[endpoint] += query_seconds
+        if repeated:
+            _nplusone[endpoint] += 1
+
+    if current_app.config['SERVER_TIMING']:
+        response.headers.add('Server-Timing', f'app;dur={elapsed * 1000:.1f}')
+        response.headers.add('Server-Timing', f'db;dur={query_seconds * 1000:.1f};desc="{queries} queries"')
+    return response
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info['metrics_started'] = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['metrics_started']
+    if not has_app_context() or 'metrics_shapes' not in g:
+        return # Not inside a request (CLI commands, background threads)
+    g.metrics_queries += 1
+    g.metrics_query_seconds += elapsed
+    g.metrics_shapes[_IN_LIST.sub('(?)', statement)] += 1
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    with _lock:
+        lines += ['# HELP dailyfocus_requests_total Requests handled.',
+                  '# TYPE dailyfocus_requests_total counter']
+        for (endpoint, method, status), n in sorted(_requests.items()):
+            lines.append(f'dailyfocus_requests_total{{endpoint="{_escape(endpoint)}",method="{method}",status="{status}"}} {n}')
+
+        lines += ['# HELP dailyfocus_request_duration_seconds Request latency.',
+                  '# TYPE dailyfocus_request_duration_seconds histogram']
+        for endpoint in sorted(_latency_count):
+            label = _escape(endpoint)
+            for bound, n in zip(BUCKETS, _latency[endpoint]):
+                lines.append(f'dailyfocus_request_duration_seconds_bucket{{endpoint="{label}",le="{bound}"}} {n}')
+            lines.append(f'dailyfocus_request_duration_seconds_bucket{{endpoint="{label}",le="+Inf"}} {_latency_count[endpoint]}')
+            lines.append(f'dailyfocus_request_duration_seconds_sum{{endpoint="{label}"}} {_latency_sum[endpoint]:.6f}')
+            lines.append(f'dailyfocus_request_duration_seconds_count{{endpoint="{label}"}} {_latency_count[endpoint]}')
+
+        lines += ['# HELP dailyfocus_db_queries_total SQL statements run while handling requests.',
+                  '# TYPE dailyfocus_db_queries_total counter']
+        for endpoint, n in sorted(_queries.items()):
+            lines.append(f'dailyfocus_db_queries_total{{endpoint="{_escape(endpoint)}"}} {n}')
+
+        lines += ['# HELP dailyfocus_db_query_seconds_total Time spent in SQL while handling requests.',
+                  '# TYPE dailyfocus_db_query_seconds_total counter']
+        for endpoint, seconds in sorted(_query_seconds.items()):
+            lines.append(f'dailyfocus_db_query_seconds_total{{endpoint="{_escape(endpoint)}"}} {seconds:.6f}')
+
+        lines += ['# HELP dailyfocus_nplusone_requests_total Requests that repeated one statement shape too often.',
+                  '# TYPE dailyfocus_nplusone_requests_total counter']
+        for endpoint, n in sorted(_nplusone.items()):
+            lines.append(f'dailyfocus_nplusone_requests_total{{endpoint="{_escape(endpoint)}"}} {n}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,100 @@
+"""Lightweight schema upgrades for existing SQLite databases.
+
+`db.create_all()` only creates missing tables, so anything added to an
+existing table (columns, indexes, constraints) is applied here. Every step is
+idempotent and safe to run on each start-up.
+"""
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateColumn
+from models import db, parse_minute
+import bitmaps
+import search
+import versions
+
+
+def _add_missing_columns(conn, inspector):
+    # New columns need a server_default (or to be nullable) for SQLite to add them
+    for table in db.metadata.sorted_tables:
+        existing = {c['name'] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                ddl = CreateColumn(column).compile(dialect=conn.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {ddl}"))
+
+
+def _dedupe_tracker_logs(conn):
+    # Collapse duplicate (date, item) rows into the oldest one, keeping it
+    # completed if any of the duplicates was.
+    conn.execute(text("""
+        UPDATE tracker_logs SET status = (
+            SELECT MAX(t2.status) FROM tracker_logs t2
+            WHERE t2.date = tracker_logs.date AND t2.routine_item_id = tracker_logs.routine_item_id
+        )
+        WHERE id IN (SELECT MIN(id) FROM tracker_logs GROUP BY date, routine_item_id HAVING COUNT(*) > 1)
+    """))
+    conn.execute(text("""
+        DELETE FROM tracker_logs
+        WHERE id NOT IN (SELECT MIN(id) FROM tracker_logs GROUP BY date, routine_item_id)
+    """))
+
+
+def _dedupe_diary_entries(conn):
+    # The app always read the oldest entry for a day; move photos from the
+    # others onto it before dropping them.
+    conn.execute(text("""
+        UPDATE diary_images SET diary_entry_id = (
+            SELECT MIN(keep.id) FROM diary_entries keep
+            JOIN diary_entries dup ON dup.date = keep.date
+            WHERE dup.id = diary_images.diary_entry_id
+        )
+        WHERE diary_entry_id IN (
+            SELECT id FROM diary_entries WHERE id NOT IN (SELECT MIN(id) FROM diary_entries GROUP BY date)
+        )
+    """))
+    conn.execute(text("""
+        DELETE FROM diary_entries
+        WHERE id NOT IN (SELECT MIN(id) FROM diary_entries GROUP BY date)
+    """))
+
+
+def _backfill_minutes(conn):
+    # Minute columns for routine items saved before they existed (or imported without them)
+    rows = conn.execute(text(
+        "SELECT id, time_start, time_end FROM routine_items "
+        "WHERE start_minute IS NULL OR (end_minute IS NULL AND time_end IS NOT NULL)"
+    )).all()
+    updates = [{'id': id, 'start': parse_minute(start), 'end': parse_minute(end)} for id, start, end in rows]
+    if updates:
+        conn.execute(text("UPDATE routine_items SET start_minute = :start, end_minute = :end WHERE id = :id"), updates)
+
+
+def upgrade():
+    """Bring the database schema up to date with models.py"""
+    db.create_all(bind_key=None)
+    with db.engine.begin() as conn:
+        inspector = inspect(conn)
+        _add_missing_columns(conn, inspector)
+
+        # Unique indexes can only be built once existing duplicates are gone
+        if 'ux_tracker_logs_date_item' not in {i['name'] for i in inspector.get_indexes('tracker_logs')}:
+            _dedupe_tracker_logs(conn)
+        if 'ux_diary_entries_date' not in {i['name'] for i in inspector.get_indexes('diary_entries')}:
+            _dedupe_diary_entries(conn)
+
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+        _backfill_minutes(conn)
+        search.install(conn)
+        versions.install(conn)
+
+    # Databases from before the bitmaps get theirs from the existing logs
+    if bitmaps.needs_backfill():
+        bitmaps.rebuild()
+        db.session.commit()
+
+
+def upgrade_directory():
+    """Create the user directory that SHARDING relies on"""
+    db.create_all(bind_key='directory')
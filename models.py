@@ -1,7 +1,33 @@
-from flask_sqlalchemy import SQLAlchemy
+import re
 from datetime import datetime
+from sqlalchemy.orm import validates
+from shards import ShardedSQLAlchemy, Shard
+
+db = ShardedSQLAlchemy()
+
+_CLOCK_TIME = re.compile(r'^\s*(\d{1,2}):(\d{2})\s*([AaPp][Mm])?\s*$')
+
+
+def parse_minute(label):
+    """Minutes past midnight for "06:30 AM", "6:30pm" or "18:30", or None if it isn't a time"""
+    match = _CLOCK_TIME.match(label or '')
+    if not match:
+        return None
+    hour, minute, half = int(match[1]), int(match[2]), match[3]
+    if half:
+        if not 1 <= hour <= 12:
+            return None
+        hour = hour % 12 + (12 if half.lower() == 'pm' else 0)
+    if hour > 23 or minute > 59:
+        return None
+    return hour * 60 + minute
+
+
+def format_minute(minute):
+    """The "06:30 AM" label for a minute of the day"""
+    hour, minute = divmod(minute, 60)
+    return f"{(hour % 12) or 12:02d}:{minute:02d} {'AM' if hour < 12 else 'PM'}"
 
-db = SQLAlchemy()
 
 class RoutineItem(db.Model):
     __tablename__ = 'routine_items'
@@ -12,6 +38,17 @@ class RoutineItem(db.Model):
     routine_type = db.Column(db.String(20), nullable=False) # 'Weekday', 'Saturday', 'Sunday'
     category = db.Column(db.String(50), nullable=True) # Health, Work, Spirit, etc.
     description = db.Column(db.String(200), nullable=True)
+    # The times as minutes past midnight, kept in step with the labels so ordering happens in SQL.
+    # None when a label isn't a time; those items sort first.
+    start_minute = db.Column(db.Integer, nullable=True)
+    end_minute = db.Column(db.Integer, nullable=True)
+
+    __table_args__ = (db.Index('ix_routine_items_type_start', 'routine_type', 'start_minute'),)
+
+    @validates('time_start', 'time_end')
+    def _set_minute(self, key, label):
+        setattr(self, 'start_minute' if key == 'time_start' else 'end_minute', parse_minute(label))
+        return label
 
     def to_dict(self):
         return {
@@ -19,6 +56,8 @@ class RoutineItem(db.Model):
             'name': self.name,
             'time_start': self.time_start,
             'time_end': self.time_end,
+            'start_minute': self.start_minute,
+            'end_minute': self.end_minute,
             'routine_type': self.routine_type,
             'category': self.category,
             'description': self.description
@@ -33,20 +72,44 @@ class TrackerLog(db.Model):
 
     routine_item = db.relationship('RoutineItem', backref=db.backref('logs', lazy=True))
 
+    # One log per item per day; also serves the dashboard's (date, item) lookups
+    __table_args__ = (db.Index('ux_tracker_logs_date_item', 'date', 'routine_item_id', unique=True),)
+
 class DiaryImage(db.Model):
     __tablename__ = 'diary_images'
     id = db.Column(db.Integer, primary_key=True)
-    diary_entry_id = db.Column(db.Integer, db.ForeignKey('diary_entries.id'), nullable=False)
+    diary_entry_id = db.Column(db.Integer, db.ForeignKey('diary_entries.id'), nullable=False, index=True)
+    image_path = db.Column(db.String(200), nullable=False, index=True) # Content hash name; shared by duplicate uploads
+
+    variants = db.relationship('DiaryImageVariant', backref='image', lazy=True, cascade='all, delete-orphan')
+
+    def variant(self, kind, fmt='jpeg'):
+        """Resized copy of this photo, or None until the background worker has built it"""
+        for v in self.variants:
+            if v.kind == kind and v.format == fmt:
+                return v
+        return None
+
+class DiaryImageVariant(db.Model):
+    __tablename__ = 'diary_image_variants'
+    id = db.Column(db.Integer, primary_key=True)
+    diary_image_id = db.Column(db.Integer, db.ForeignKey('diary_images.id'), nullable=False, index=True)
+    kind = db.Column(db.String(20), nullable=False) # 'thumb' (grid tile) or 'modal' (lightbox)
+    format = db.Column(db.String(10), nullable=False) # 'jpeg' or 'webp'
+    width = db.Column(db.Integer, nullable=False)
+    height = db.Column(db.Integer, nullable=False)
     image_path = db.Column(db.String(200), nullable=False)
 
 class DiaryEntry(db.Model):
     __tablename__ = 'diary_entries'
     id = db.Column(db.Integer, primary_key=True)
     date = db.Column(db.Date, nullable=False, default=datetime.utcnow().date)
+    __table_args__ = (db.Index('ux_diary_entries_date', 'date', unique=True),) # One entry per day
     content = db.Column(db.Text, nullable=True)
     image_path = db.Column(db.String(200), nullable=True) # Kept for legacy/primary thumbnail if needed, or deprecate
     pinned_text = db.Column(db.String(200), nullable=True) # Highlight/Pinned thought for the day
     mood = db.Column(db.String(50), nullable=True)
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0') # Bumped on every save; autosave checks it to avoid lost updates
     
     images = db.relationship('DiaryImage', backref='entry', lazy=True)
 
@@ -58,18 +121,56 @@ class DiaryEntry(db.Model):
             'image_path': self.image_path,
             'pinned_text': self.pinned_text,
             'mood': self.mood,
+            'version': self.version,
             'images': [img.image_path for img in self.images]
         }
 
 class Reminder(db.Model):
     __tablename__ = 'reminders'
     id = db.Column(db.Integer, primary_key=True)
-    date = db.Column(db.Date, nullable=False)
+    date = db.Column(db.Date, nullable=False, index=True)
     message = db.Column(db.String(200), nullable=False)
     is_completed = db.Column(db.Boolean, default=False)
+    time = db.Column(db.String(5), nullable=True) # "HH:MM"; timed reminders are delivered when due
+    recurrence = db.Column(db.String(10), nullable=True) # None for one day, else a key of reminders.RECURRENCES starting on `date`
+    until = db.Column(db.Date, nullable=True) # Last day a recurring reminder can occur
 
 class UserSetting(db.Model):
     __tablename__ = 'user_settings'
     id = db.Column(db.Integer, primary_key=True)
     key = db.Column(db.String(50), unique=True, nullable=False)
     value = db.Column(db.String(200), nullable=True)
+
+class RoutineRollup(db.Model):
+    __tablename__ = 'routine_rollups'
+    id = db.Column(db.Integer, primary_key=True)
+    date = db.Column(db.Date, nullable=False)
+    routine_item_id = db.Column(db.Integer, db.ForeignKey('routine_items.id'), nullable=False)
+    completions = db.Column(db.Integer, nullable=False, default=0) # Completed logs for this item on this day
+
+    __table_args__ = (db.UniqueConstraint('date', 'routine_item_id', name='uq_routine_rollup_day_item'),)
+
+class DiaryRollup(db.Model):
+    __tablename__ = 'diary_rollups'
+    id = db.Column(db.Integer, primary_key=True)
+    date = db.Column(db.Date, unique=True, nullable=False)
+    has_content = db.Column(db.Boolean, nullable=False, default=False) # True if that day's entry has text
+
+class CompletionBitmap(db.Model):
+    __tablename__ = 'completion_bitmaps'
+    routine_item_id = db.Column(db.Integer, db.ForeignKey('routine_items.id'), primary_key=True)
+    start_day = db.Column(db.Integer, nullable=False) # Day of bit 0, in days since 1970-01-01 (a multiple of 8)
+    bits = db.Column(db.LargeBinary, nullable=False)  # One bit per day, set if completed; bit 0 is the low bit of byte 0
+
+class User(db.Model):
+    """Account in the directory database; its journal lives in its own shard"""
+    __tablename__ = 'users'
+    __bind_key__ = 'directory'
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(80), unique=True, nullable=False)
+    password_hash = db.Column(db.String(200), nullable=False)
+    bucket = db.Column(db.Integer, nullable=False) # Shard directory holding this user's database
+
+    @property
+    def shard(self):
+        return Shard(self.id, self.bucket)
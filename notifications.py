@@ -0,0 +1,75 @@
+"""Local notification channel for events raised inside the app process.
+
+Anything can `publish` an event; every subscriber has its own bounded
+queue, so a slow reader drops its oldest events instead of holding up the
+publisher or anyone else. Events carry the shard they belong to, and a
+subscription only sees its own user's events when sharding is on.
+Listeners see every event as it is published, for fan-out that does its
+own routing (the live update hub).
+"""
+import itertools
+import threading
+import time
+from collections import deque
+
+QUEUE_SIZE = 100 # Events kept per subscriber before the oldest are dropped
+
+_subscribers = set()
+_listeners = []
+_lock = threading.Lock()
+_ids = itertools.count(1)
+
+
+class Subscription:
+    """One reader's queue of events"""
+
+    def __init__(self, shard):
+        self.shard = shard
+        self.events = deque(maxlen=QUEUE_SIZE)
+        self._ready = threading.Condition()
+
+    def put(self, event):
+        with self._ready:
+            self.events.append(event)
+            self._ready.notify()
+
+    def get(self, timeout=None):
+        """Next event, or None if nothing arrived within `timeout` seconds"""
+        with self._ready:
+            if not self.events:
+                self._ready.wait(timeout)
+            return self.events.popleft() if self.events else None
+
+    def close(self):
+        unsubscribe(self)
+
+
+def subscribe(shard=None):
+    subscription = Subscription(shard)
+    with _lock:
+        _subscribers.add(subscription)
+    return subscription
+
+
+def unsubscribe(subscription):
+    with _lock:
+        _subscribers.discard(subscription)
+
+
+def listen(callback):
+    """Call `callback(event, shard)` in the publisher's thread for every event; it must not block"""
+    with _lock:
+        _listeners.append(callback)
+
+
+def publish(kind, data, shard=None):
+    """Hand an event to every subscriber of `shard`; returns the event"""
+    event = {'id': next(_ids), 'kind': kind, 'data': data, 'time': time.time()}
+    with _lock:
+        subscribers = [s for s in _subscribers if s.shard == shard]
+        listeners = list(_listeners)
+    for subscription in subscribers:
+        subscription.put(event)
+    for callback in listeners:
+        callback(event, shard)
+    return event
@@ -0,0 +1,145 @@
+"""Content-addressed storage for uploaded photos.
+
+Uploads are hashed as they stream from the request into a temporary file
+in UPLOAD_STAGING_FOLDER, outside the served static folder, so each photo
+is read once and never held in memory. The file is then moved into the
+upload folder as `<sha256>.<ext>`; a photo that is already on disk is not
+stored twice. DiaryImage rows pointing at the same file are its
+references, and the file and its resized variants are only unlinked once
+the last of them is deleted.
+
+Storing and releasing both happen inside a database write transaction:
+uploads store their files after the entry upsert, and deletes unlink
+before they commit. SQLite lets one writer in at a time, so a delete can't
+check the references, see none and unlink a file that a concurrent upload
+has just decided to reuse.
+"""
+import hashlib
+import os
+import re
+import tempfile
+from flask import Request, current_app
+from werkzeug.exceptions import RequestEntityTooLarge
+from models import db, DiaryImage, DiaryImageVariant
+import shards
+import thumbnails
+
+CHUNK_SIZE = 64 * 1024
+
+_DIGEST_NAME = re.compile(r'^[0-9a-f]{64}\.\w+$')
+
+
+class HashingFile:
+    """Temporary file that hashes and size-checks an upload as the form parser writes it"""
+
+    def __init__(self, folder, staging_folder, limit):
+        self._file = tempfile.NamedTemporaryFile(dir=staging_folder, prefix='.upload-', delete=False)
+        self.folder = folder
+        self._hash = hashlib.sha256()
+        self.size = 0
+        self.limit = limit
+        self.stored_name = None
+
+    def write(self, data):
+        self.size += len(data)
+        if self.limit and self.size > self.limit:
+            self.close()
+            raise RequestEntityTooLarge(f"Photos can be at most {self.limit // (1024 * 1024)} MB.")
+        self._hash.update(data)
+        return self._file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name) # read, seek, closed... for FileStorage
+
+    def store(self, extension):
+        """Move the upload into place under its digest and return that file name.
+
+        If the same photo is already stored the upload is kept aside until the
+        request ends, so calling it again (e.g. when a write is retried after a
+        delete unlinked the file) puts the photo back under the same name.
+        """
+        name = f"{self._hash.hexdigest()}.{extension}"
+        target = os.path.join(self.folder, name)
+        self._file.close()
+        if not os.path.exists(target) and os.path.exists(self._file.name):
+            os.replace(self._file.name, target)
+        self.stored_name = name
+        return name
+
+    def close(self):
+        self._file.close()
+        thumbnails.remove_file(*os.path.split(self._file.name)) # Rejected, failed, or a copy of a stored photo
+
+
+class UploadRequest(Request):
+    """Request whose file uploads stream through HashingFile"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        staging_folder = current_app.config['UPLOAD_STAGING_FOLDER']
+        os.makedirs(staging_folder, exist_ok=True)
+        return HashingFile(shards.upload_folder(), staging_folder, current_app.config.get('MAX_PHOTO_SIZE'))
+
+
+def is_referenced(image_path):
+    return db.session.query(DiaryImage.id).filter_by(image_path=image_path).first() is not None
+
+
+def release(upload_folder, image_path, variant_paths):
+    """Unlink a photo and its variants once no DiaryImage uses it any more.
+
+    Call it after flushing the delete and before committing, so the check
+    and the unlink happen while this transaction holds the write lock.
+    """
+    if is_referenced(image_path):
+        return False
+    for filename in [image_path, *variant_paths]:
+        thumbnails.remove_file(upload_folder, filename)
+    return True
+
+
+def _digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def dedupe_existing(upload_folder):
+    """Move photos stored under their upload names to digest names, merging duplicates.
+
+    Returns (files checked, bytes freed).
+    """
+    checked = freed = 0
+    legacy = [path for (path,) in db.session.query(DiaryImage.image_path).distinct() if not _DIGEST_NAME.match(path)]
+    for old_name in legacy:
+        old_path = os.path.join(upload_folder, old_name)
+        if not os.path.isfile(old_path):
+            continue
+        extension = old_name.rsplit('.', 1)[-1].lower()
+        new_name = f"{_digest(old_path)}.{extension}"
+        new_path = os.path.join(upload_folder, new_name)
+        if os.path.exists(new_path):
+            freed += os.path.getsize(old_path)
+            os.remove(old_path)
+        else:
+            os.replace(old_path, new_path)
+        DiaryImage.query.filter_by(image_path=old_name).update({'image_path': new_name})
+
+        # Variants follow their original's name; keep one copy of each
+        variants = DiaryImageVariant.query.join(DiaryImage).filter(DiaryImage.image_path == new_name).all()
+        for variant in variants:
+            target = thumbnails.variant_filename(new_name, variant.kind, variant.format)
+            if variant.image_path == target:
+                continue
+            source = os.path.join(upload_folder, variant.image_path)
+            if os.path.exists(source):
+                if os.path.exists(os.path.join(upload_folder, target)):
+                    freed += os.path.getsize(source)
+                    os.remove(source)
+                else:
+                    os.replace(source, os.path.join(upload_folder, target))
+            variant.image_path = target
+        db.session.commit()
+        checked += 1
+    return checked, freed
@@ -0,0 +1,268 @@
+"""Recurring reminders, and a scheduler that delivers them when they come due.
+
+A reminder with a `recurrence` is a rule rather than one row per day. It
+starts on its `date`, repeats daily, on weekdays, on weekends, weekly or
+monthly, and stops after `until` when that is set. Occurrences are worked
+out arithmetically for whichever day is being looked at, so nothing is ever
+expanded into rows.
+
+Reminders with a `time` are also delivered. One scheduler thread keeps the
+upcoming occurrences in a min-heap and sleeps until the earliest is due;
+saving a reminder only wakes it when the new one comes first. The heap
+holds at most one occurrence per rule, and only those inside the current
+window (`REMINDER_WINDOW`, a day), so thousands of rules cost one entry
+each and O(log n) per delivery. When the window ends the rules are read
+again for the next one. Each occurrence is checked against the database as
+it fires, so a reminder that was deleted, completed or moved never fires
+stale. Occurrences that fell due while the app was not running are not
+replayed.
+
+Due reminders are published on the notification channel and, when
+NOTIFY_COMMAND is set (`notify-send` if it is installed), shown on the
+desktop. Every process runs its own scheduler, so a server with several
+worker processes should keep it on in one of them only.
+"""
+import heapq
+import itertools
+import shutil
+import subprocess
+import threading
+from calendar import monthrange
+from datetime import datetime, timedelta
+from sqlalchemy import and_, or_
+from models import db, Reminder, User
+import notifications
+import shards
+
+RECURRENCES = {
+    'daily': 'Every day',
+    'weekdays': 'Weekdays',
+    'weekends': 'Weekends',
+    'weekly': 'Every week',
+    'monthly': 'Every month',
+}
+
+_scheduler = None
+_lock = threading.Lock()
+
+
+def init_app(app):
+    app.config.setdefault('REMINDER_SCHEDULER', True)
+    app.config.setdefault('REMINDER_WINDOW', 24 * 60 * 60) # Seconds of upcoming occurrences kept in the heap
+    if shutil.which('notify-send') and not app.config['SHARDING']:
+        app.config.setdefault('NOTIFY_COMMAND', ['notify-send', '--app-name=DailyFocus'])
+    app.add_template_global(RECURRENCES, 'reminder_recurrences')
+
+    @app.before_request
+    def start_scheduler():
+        # Started by the first request, so the reloader's parent process and CLI commands never run one
+        if app.config['REMINDER_SCHEDULER']:
+            get_scheduler(app).start()
+
+
+def _in_month(year, month, day):
+    # Monthly reminders set for the 31st fall on the last day of shorter months
+    return datetime(year, month, min(day, monthrange(year, month)[1])).date()
+
+
+def next_date(rule, day):
+    """First day on or after `day` that `rule` occurs, or None if it never occurs again.
+
+    `rule` is anything with `date`, `recurrence` and `until`: a Reminder or a row of those columns.
+    """
+    start = rule.date
+    day = max(day, start)
+    if not rule.recurrence:
+        found = start if day == start else None
+    elif rule.recurrence == 'daily':
+        found = day
+    elif rule.recurrence == 'weekdays':
+        found = day + timedelta(days=7 - day.weekday() if day.weekday() >= 5 else 0)
+    elif rule.recurrence == 'weekends':
+        found = day + timedelta(days=max(0, 5 - day.weekday()))
+    elif rule.recurrence == 'weekly':
+        found = day + timedelta(days=(start - day).days % 7)
+    elif rule.recurrence == 'monthly':
+        found = _in_month(day.year, day.month, start.day)
+        if found < day:
+            year, month = divmod(day.year * 12 + day.month, 12) # The month after day's
+            found = _in_month(year, month + 1, start.day)
+    else:
+        found = None
+    if found is not None and rule.until is not None and found > rule.until:
+        return None
+    return found
+
+
+def occurs_on(rule, day):
+    return next_date(rule, day) == day
+
+
+def next_due(rule, after):
+    """The first time `rule` is due strictly after the datetime `after`, or None"""
+    day = next_date(rule, after.date())
+    while day is not None:
+        due = datetime.strptime(f"{day} {rule.time}", '%Y-%m-%d %H:%M')
+        if due > after:
+            return due
+        day = next_date(rule, day + timedelta(days=1))
+    return None
+
+
+def for_day(day):
+    """Reminders to show on `day`: its own reminders plus the rules that occur on it, by time"""
+    candidates = Reminder.query.filter(or_(
+        Reminder.date == day,
+        and_(Reminder.recurrence.isnot(None), Reminder.date <= day,
+             or_(Reminder.until.is_(None), Reminder.until >= day)),
+    )).order_by(Reminder.time, Reminder.id)
+    return [reminder for reminder in candidates if occurs_on(reminder, day)]
+
+
+def _timed_rules(first, last):
+    """Light rows for every timed reminder that can occur between two days"""
+    return (
+        db.session.query(Reminder.id, Reminder.date, Reminder.time, Reminder.recurrence, Reminder.until)
+        .filter(Reminder.time.isnot(None), Reminder.date <= last, or_(
+            and_(Reminder.recurrence.is_(None), Reminder.date >= first, Reminder.is_completed.isnot(True)),
+            and_(Reminder.recurrence.isnot(None), or_(Reminder.until.is_(None), Reminder.until >= first)),
+        ))
+        .all()
+    )
+
+
+def deliver(app, shard, reminder, due):
+    """Announce one due occurrence on the notification channel, and on the desktop if configured"""
+    notifications.publish('reminder-due', {
+        'id': reminder.id,
+        'message': reminder.message,
+        'date': due.date().isoformat(),
+        'time': reminder.time,
+    }, shard)
+    app.logger.info("Reminder due at %s: %s", due, reminder.message)
+    command = app.config.get('NOTIFY_COMMAND')
+    if command:
+        try:
+            subprocess.run([*command, 'Reminder', reminder.message], timeout=5,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except (OSError, subprocess.SubprocessError) as e:
+            app.logger.warning("Could not run %s: %s", command[0], e)
+
+
+class Scheduler:
+    """Thread that sleeps until the earliest queued reminder is due, then delivers it"""
+
+    def __init__(self, app):
+        self.app = app
+        self.window = timedelta(seconds=app.config['REMINDER_WINDOW'])
+        self._heap = []            # (due, seq, shard, reminder id); seq breaks ties
+        self._queued = set()       # (due, shard, reminder id) in the heap, so nothing is queued twice
+        self._seq = itertools.count()
+        self._window_end = None    # Occurrences from here on wait for the next load
+        self._wake = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._wake:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='reminders', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        with self._wake:
+            self._stopped = True
+            self._wake.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def add(self, shard, reminder):
+        """Queue a just-saved reminder's next occurrence if it falls in the current window"""
+        due = next_due(reminder, datetime.now())
+        with self._wake:
+            # Before the first load nothing needs doing: the load reads the reminder itself
+            if self._window_end is not None and self._push(due, shard, reminder.id):
+                if self._heap[0][0] == due:
+                    self._wake.notify()
+
+    def _push(self, due, shard, reminder_id):
+        key = (due, shard, reminder_id)
+        if due is None or due >= self._window_end or key in self._queued:
+            return False
+        self._queued.add(key)
+        heapq.heappush(self._heap, (due, next(self._seq), shard, reminder_id))
+        return True
+
+    def _next_job(self):
+        """Block until an occurrence is due (returned) or the window has run out (None)"""
+        with self._wake:
+            while not self._stopped:
+                now = datetime.now()
+                if self._window_end is None or now >= self._window_end:
+                    return None
+                if self._heap and self._heap[0][0] <= now:
+                    due, _, shard, reminder_id = heapq.heappop(self._heap)
+                    self._queued.discard((due, shard, reminder_id))
+                    return due, shard, reminder_id
+                wake_at = min(self._heap[0][0], self._window_end) if self._heap else self._window_end
+                self._wake.wait((wake_at - now).total_seconds())
+            return False
+
+    def _run(self):
+        while (job := self._next_job()) is not False:
+            try:
+                if job is None:
+                    self._load()
+                else:
+                    self._fire(*job)
+            except Exception:
+                self.app.logger.exception("Reminder scheduler failed")
+
+    def _shards(self):
+        if not self.app.config['SHARDING']:
+            return [None]
+        with self.app.app_context():
+            return [user.shard for user in User.query.all()]
+
+    def _load(self):
+        """Open the next window and queue each timed rule's next occurrence in it"""
+        now = datetime.now()
+        with self._wake:
+            # Set first, so reminders saved while the rules are read are queued by add()
+            self._window_end = end = now + self.window
+        for shard in self._shards():
+            with shards.app_context(self.app, shard):
+                upcoming = [(next_due(rule, now), rule.id) for rule in _timed_rules(now.date(), end.date())]
+            with self._wake:
+                for due, reminder_id in upcoming:
+                    self._push(due, shard, reminder_id)
+
+    def _fire(self, due, shard, reminder_id):
+        with shards.app_context(self.app, shard):
+            reminder = db.session.get(Reminder, reminder_id)
+            if reminder is None or reminder.time is None or (reminder.is_completed and not reminder.recurrence):
+                return
+            if next_due(reminder, due - timedelta(seconds=1)) != due:
+                return # Moved since it was queued; its new time has its own entry
+            deliver(self.app, shard, reminder, due)
+            following = next_due(reminder, due)
+        with self._wake:
+            self._push(following, shard, reminder_id)
+
+
+def get_scheduler(app):
+    global _scheduler
+    if _scheduler is not None:
+        return _scheduler
+    with _lock:
+        if _scheduler is None:
+            _scheduler = Scheduler(app)
+    return _scheduler
+
+
+def saved(reminder):
+    """Tell this process's scheduler, if it runs, about a new or changed reminder"""
+    if _scheduler is not None and reminder.time:
+        _scheduler.add(shards.current(), reminder)
@@ -0,0 +1,91 @@
+"""Daily rollups backing the analytics page.
+
+The write routes keep these tables current one row at a time, so /analytics
+only ever aggregates over (days x routines) instead of raw log rows. Habit
+writes also flip the item's bit in its completion bitmap (bitmaps.py).
+Years moved out by archive.py keep no daily routine rollups; their totals
+are counted from the completion bitmaps instead.
+Run `flask --app app rebuild-rollups` to regenerate them from scratch.
+"""
+from datetime import date
+from sqlalchemy import func, case, true
+from sqlalchemy.dialects.sqlite import insert
+from models import db, TrackerLog, DiaryEntry, RoutineRollup, DiaryRollup
+import archive
+import bitmaps
+
+
+def record_habit(log_date, routine_item_id, status):
+    """Store the completion state of one item on one day"""
+    record_habits([{'date': log_date, 'routine_item_id': routine_item_id, 'status': status}])
+
+
+def record_habits(changes):
+    """Store many {date, routine_item_id, status} changes in one executemany"""
+    stmt = insert(RoutineRollup)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['date', 'routine_item_id'],
+        set_={'completions': stmt.excluded.completions}
+    )
+    db.session.execute(stmt, [
+        {'date': c['date'], 'routine_item_id': c['routine_item_id'], 'completions': 1 if c['status'] else 0}
+        for c in changes
+    ])
+    bitmaps.record(changes)
+
+
+def record_diary(entry_date, content):
+    """Store whether the diary for a day has any text"""
+    stmt = insert(DiaryRollup).values(date=entry_date, has_content=bool(content))
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['date'],
+        set_={'has_content': stmt.excluded.has_content}
+    )
+    db.session.execute(stmt)
+
+
+def _live(column, archived):
+    """Condition keeping a date column out of the archived years"""
+    if not archived:
+        return true()
+    return func.strftime('%Y', column).notin_([str(year) for year in archived])
+
+
+def totals():
+    """{routine_item_id: completions} over the whole history, archived years included"""
+    archived = archive.years()
+    counts = dict(
+        db.session.query(RoutineRollup.routine_item_id, func.sum(RoutineRollup.completions))
+        .filter(_live(RoutineRollup.date, archived))
+        .group_by(RoutineRollup.routine_item_id)
+    )
+    for year in archived:
+        for item_id, completions in bitmaps.totals(date(year, 1, 1), date(year, 12, 31)).items():
+            counts[item_id] = counts.get(item_id, 0) + completions
+    return counts
+
+
+def rebuild():
+    """Recompute the rollup tables from the raw logs and entries, and the bitmaps from every log (archived too)"""
+    db.session.query(RoutineRollup).delete()
+    db.session.query(DiaryRollup).delete()
+
+    completed = func.sum(case((TrackerLog.status == True, 1), else_=0))
+    db.session.execute(
+        insert(RoutineRollup).from_select(
+            ['date', 'routine_item_id', 'completions'],
+            db.select(TrackerLog.date, TrackerLog.routine_item_id, completed)
+            .where(_live(TrackerLog.date, archive.years()))
+            .group_by(TrackerLog.date, TrackerLog.routine_item_id)
+        )
+    )
+
+    has_content = func.max(case((func.coalesce(DiaryEntry.content, '') != '', 1), else_=0))
+    db.session.execute(
+        insert(DiaryRollup).from_select(
+            ['date', 'has_content'],
+            db.select(DiaryEntry.date, has_content).group_by(DiaryEntry.date)
+        )
+    )
+    bitmaps.rebuild()
+    db.session.commit()
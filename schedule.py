@@ -0,0 +1,69 @@
+"""In-process cache of the routine schedule the dashboard renders.
+
+Routine items and the target score change rarely but are read on every
+dashboard hit, so each routine type's items are loaded once, already in
+start-time order from the database, and kept with the data version of
+`routine_items` and `user_settings` (see versions.py). Every read checks
+that version in one small query and reloads when it has moved, so all
+worker processes see a change on their next request. With SHARDING on,
+entries are kept per user.
+"""
+from threading import Lock
+from models import RoutineItem, UserSetting
+import shards
+import versions
+
+DEFAULT_TARGET_SCORE = 80
+
+_lock = Lock()
+_schedules = {} # (shard, routine type) -> (data version, item dicts)
+_settings = {} # (shard, 'target_score') -> (data version, value)
+
+
+def routine_type_for(day):
+    # Simple logic: Sat/Sun = Weekend, else Weekday
+    return 'Weekend' if day.weekday() >= 5 else 'Weekday'
+
+
+def ordered(query):
+    """Routine items in start-time order, served by the (routine_type, start_minute) index"""
+    return query.order_by(RoutineItem.routine_type, RoutineItem.start_minute, RoutineItem.id)
+
+
+def _version():
+    # Read before loading, so a write that lands during the load only makes the next read reload
+    version, _ = versions.current(['routine_items', 'user_settings'])
+    return version
+
+
+def get_schedule(routine_type):
+    """Items for a routine type as dicts, ordered by start time"""
+    key = (shards.current(), routine_type)
+    version = _version()
+    cached = _schedules.get(key)
+    if cached and cached[0] == version:
+        return cached[1]
+    items = [item.to_dict() for item in ordered(RoutineItem.query.filter_by(routine_type=routine_type))]
+    with _lock:
+        _schedules[key] = (version, items)
+    return items
+
+
+def get_target_score():
+    key = (shards.current(), 'target_score')
+    version = _version()
+    cached = _settings.get(key)
+    if cached and cached[0] == version:
+        return cached[1]
+    setting = UserSetting.query.filter_by(key='target_score').first()
+    target_score = int(setting.value) if setting else DEFAULT_TARGET_SCORE
+    with _lock:
+        _settings[key] = (version, target_score)
+    return target_score
+
+
+def invalidate():
+    """Drop everything cached; the data version already catches changes, this just frees the memory sooner"""
+    with _lock:
+        _schedules.clear()
+        _settings.clear()
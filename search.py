@@ -0,0 +1,102 @@
+"""Full-text search over diary entries, backed by an SQLite FTS5 index.
+
+`diary_search` is an external-content FTS5 table over `diary_entries`;
+triggers keep it in step with every insert, update and delete, whichever
+route (or upsert) made the change.
+"""
+import re
+from datetime import date
+from markupsafe import Markup, escape
+from sqlalchemy import text
+
+# Highlight markers FTS5 wraps around matches; swapped for <mark> after escaping
+_OPEN, _CLOSE = '\x02', '\x03'
+
+_SCHEMA = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS diary_search USING fts5(
+        content, pinned_text, mood,
+        content='diary_entries', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS diary_search_ai AFTER INSERT ON diary_entries BEGIN
+        INSERT INTO diary_search(rowid, content, pinned_text, mood)
+        VALUES (new.id, new.content, new.pinned_text, new.mood);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS diary_search_ad AFTER DELETE ON diary_entries BEGIN
+        INSERT INTO diary_search(diary_search, rowid, content, pinned_text, mood)
+        VALUES ('delete', old.id, old.content, old.pinned_text, old.mood);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS diary_search_au AFTER UPDATE OF content, pinned_text, mood ON diary_entries BEGIN
+        INSERT INTO diary_search(diary_search, rowid, content, pinned_text, mood)
+        VALUES ('delete', old.id, old.content, old.pinned_text, old.mood);
+        INSERT INTO diary_search(rowid, content, pinned_text, mood)
+        VALUES (new.id, new.content, new.pinned_text, new.mood);
+    END
+    """,
+]
+
+_QUERY = text("""
+    SELECT e.id, e.date,
+           snippet(diary_search, 0, :open, :close, '…', 32) AS content,
+           highlight(diary_search, 1, :open, :close) AS pinned_text,
+           e.mood
+    FROM diary_search
+    JOIN diary_entries e ON e.id = diary_search.rowid
+    WHERE diary_search MATCH :match
+    ORDER BY bm25(diary_search, 1.0, 2.0, 1.0)
+    LIMIT :limit OFFSET :offset
+""")
+
+
+def install(conn):
+    """Create the index and its triggers, filling it from existing entries the first time"""
+    exists = conn.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'diary_search'"
+    )).first()
+    for statement in _SCHEMA:
+        conn.execute(text(statement))
+    if not exists:
+        conn.execute(text("INSERT INTO diary_search(diary_search) VALUES ('rebuild')"))
+
+
+def to_match(query):
+    """Turn free text into a safe FTS5 expression: every word must match, the last as a prefix"""
+    words = re.findall(r'\w+', query)
+    if not words:
+        return None
+    terms = [f'"{w}"' for w in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def _highlight(value):
+    return Markup(str(escape(value or '')).replace(_OPEN, '<mark>').replace(_CLOSE, '</mark>'))
+
+
+def search_entries(session, query, page=1, per_page=20):
+    """Ranked matches for one page of results, plus whether another page follows"""
+    match = to_match(query)
+    if match is None:
+        return [], False
+    rows = session.execute(_QUERY, {
+        'open': _OPEN,
+        'close': _CLOSE,
+        'match': match,
+        'limit': per_page + 1,
+        'offset': (page - 1) * per_page,
+    }).all()
+    results = [{
+        'id': row.id,
+        'date': date.fromisoformat(row.date),
+        'content': _highlight(row.content),
+        'pinned_text': _highlight(row.pinned_text),
+        'mood': row.mood,
+    } for row in rows[:per_page]]
+    return results, len(rows) > per_page
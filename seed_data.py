@@ -1,9 +1,10 @@
 from app import app, db
+import migrations
 from models import RoutineItem
 
 def seed_data():
     with app.app_context():
-        db.create_all()
+        migrations.upgrade()
         
         if RoutineItem.query.first():
             print("To prevent duplicates, clearing existing data...")
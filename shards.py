@@ -0,0 +1,179 @@
+"""Per-user database shards, so one deployment can host many journals.
+
+With `SHARDING` on, every user's journal lives in its own SQLite file, under
+one of `SHARD_BUCKETS` bucket directories chosen by hashing the username.
+Bucket directories can sit on different disks. A small directory database
+(the `directory` bind) maps users to their bucket.
+
+`db` is a ShardedSQLAlchemy: while a request (or CLI command) has a user
+active, its default engine is that user's shard. Every query, `db.engine`
+and migration in the app therefore follows the user without changing.
+Engines are opened on first use, migrated, and kept in an LRU of
+`SHARD_ENGINE_CACHE` entries. The least recently used engine is disposed
+when the LRU is full.
+
+With `SHARDING` off nothing is active and the app uses its single database
+as before.
+"""
+import os
+import sqlite3
+import threading
+import zlib
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from functools import wraps
+import click
+from flask import current_app, g, has_app_context, url_for
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import create_engine
+
+Shard = namedtuple('Shard', 'user_id bucket')
+
+_engines = OrderedDict() # Shard -> Engine, most recently used last
+_lock = threading.RLock()
+
+
+class ShardedSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy extension whose default engine is the active user's shard"""
+
+    @property
+    def engines(self):
+        engines = super().engines
+        shard = current()
+        if shard is None:
+            return engines
+        return {**engines, None: engine_for(shard)}
+
+
+def init_app(app):
+    app.config.setdefault('SHARDING', False)
+    app.config.setdefault('SHARD_ROOT', os.path.join(app.instance_path, 'shards'))
+    app.config.setdefault('SHARD_BUCKETS', 4)
+    app.config.setdefault('SHARD_ENGINE_CACHE', 32)
+    if app.config['SHARDING']:
+        app.config.setdefault('SQLALCHEMY_BINDS', {}).setdefault(
+            'directory', 'sqlite:///' + os.path.join(app.instance_path, 'directory.db'))
+    app.add_template_global(upload_url)
+
+
+def current():
+    """The active user's shard, or None in single-user mode"""
+    return g.get('shard') if has_app_context() else None
+
+
+def activate(shard):
+    g.shard = shard
+
+
+@contextmanager
+def app_context(app, shard):
+    """App context with `shard` active, for work that runs outside the request (thumbnail callbacks)"""
+    with app.app_context():
+        activate(shard)
+        yield
+
+
+def bucket_for(username, buckets):
+    return zlib.crc32(username.encode()) % buckets
+
+
+def database_path(shard, root=None):
+    root = root or current_app.config['SHARD_ROOT']
+    return os.path.join(root, str(shard.bucket), f'user_{shard.user_id}.db')
+
+
+def engine_for(shard):
+    with _lock:
+        engine = _engines.get(shard)
+        if engine is not None:
+            _engines.move_to_end(shard)
+            return engine
+
+        path = database_path(shard)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        engine = create_engine('sqlite:///' + path, **current_app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+        _engines[shard] = engine
+        while len(_engines) > current_app.config['SHARD_ENGINE_CACHE']:
+            _engines.popitem(last=False)[1].dispose()
+
+        # New or not, bring the shard's schema up to date once per process. Its own
+        # context makes it the active shard even when another one (or none) is.
+        import migrations
+        with app_context(current_app._get_current_object(), shard):
+            migrations.upgrade()
+        return engine
+
+
+def dispose_all():
+    with _lock:
+        while _engines:
+            _engines.popitem()[1].dispose()
+
+
+def upload_folder():
+    """Where the active user's photos live; each user gets a subfolder"""
+    folder = current_app.config['UPLOAD_FOLDER']
+    shard = current()
+    if shard is not None:
+        folder = os.path.join(folder, f'u{shard.user_id}')
+        os.makedirs(folder, exist_ok=True)
+    return folder
+
+
+def upload_url(filename):
+    shard = current()
+    prefix = f'uploads/u{shard.user_id}/' if shard is not None else 'uploads/'
+    return url_for('static', filename=prefix + filename)
+
+
+def user_option(command):
+    """Add --user to a CLI command, activating that user's shard when sharding is on"""
+    @click.option('--user', 'username', help="Whose journal to use when SHARDING is on.")
+    @wraps(command)
+    def wrapper(username, *args, **kwargs):
+        if current_app.config['SHARDING']:
+            from models import User
+            user = User.query.filter_by(username=username).first() if username else None
+            if user is None:
+                raise click.UsageError("--user must name an existing user when SHARDING is on.")
+            activate(user.shard)
+        return command(*args, **kwargs)
+    return wrapper
+
+
+def checkpoint(path):
+    """Fold a database's WAL back into the main file so it can be moved as one file"""
+    connection = sqlite3.connect(path)
+    try:
+        connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    finally:
+        connection.close()
+
+
+def plan_rebalance(users, buckets, sizes=None):
+    """New bucket for each user: by username hash, or by size so buckets hold similar bytes.
+
+    `users` is a list of (user_id, username); `sizes` maps user_id to bytes.
+    """
+    if sizes is None:
+        return {user_id: bucket_for(username, buckets) for user_id, username in users}
+    totals = [0] * buckets
+    plan = {}
+    for user_id, _ in sorted(users, key=lambda u: sizes.get(u[0], 0), reverse=True):
+        bucket = totals.index(min(totals))
+        plan[user_id] = bucket
+        totals[bucket] += sizes.get(user_id, 0)
+    return plan
+
+
+def move(shard, bucket, root):
+    """Move one user's database file (and any WAL leftovers) into another bucket"""
+    source = database_path(shard, root)
+    target = database_path(Shard(shard.user_id, bucket), root)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if os.path.exists(source):
+        checkpoint(source)
+        os.replace(source, target)
+    for suffix in ('-wal', '-shm'):
+        if os.path.exists(source + suffix):
+            os.remove(source + suffix)
@@ -0,0 +1,127 @@
+"""Streaks, rolling completion rates and the year heatmap, computed with NumPy.
+
+Completed logs are loaded into a dense boolean matrix of days x routine
+items. A cell only counts when the item applies that day, e.g. Weekend items
+on Saturdays and Sundays, so days an item isn't scheduled never break its
+streak. Each metric is a handful of array operations over the whole
+matrix rather than a Python loop over log rows.
+"""
+import numpy as np
+from datetime import date, timedelta
+from models import RoutineItem
+import archive
+import bitmaps
+
+HEATMAP_DAYS = 365
+ROLLING_DAYS = 90 # Length of the rolling 7-day rate series
+
+def _load(today):
+    """Item metadata, and the day numbers and item columns of every completed log"""
+    items = RoutineItem.query.order_by(RoutineItem.id).all()
+    log_days, log_items = archive.completed(until=today)
+    return items, log_days, log_items
+
+
+def _runs(done):
+    """Length of the completed run ending on each row, per column"""
+    count = np.cumsum(done, axis=0)
+    resets = np.maximum.accumulate(np.where(done, 0, count), axis=0)
+    return count - resets
+
+
+def _streaks(done, weekend, item_types):
+    """Current and longest streak per item, counted over the days each item applies.
+
+    Today only extends a streak once it's ticked off; an unticked today
+    leaves yesterday's streak standing.
+    """
+    current = np.zeros(done.shape[1], dtype=np.int64)
+    longest = np.zeros(done.shape[1], dtype=np.int64)
+    today_row = len(weekend) - 1
+    # Items of one routine type share their scheduled days, so each type compresses to a dense block
+    for routine_type in bitmaps.ROUTINE_TYPES:
+        rows = np.flatnonzero(bitmaps.applies(routine_type, weekend))
+        columns = np.flatnonzero(item_types == routine_type)
+        if not len(columns) or not len(rows):
+            continue
+        block = done[np.ix_(rows, columns)]
+        runs = _runs(block)
+        longest[columns] = runs.max(axis=0)
+        latest = runs[-1]
+        if rows[-1] == today_row and len(rows) > 1:
+            latest = np.where(block[-1], runs[-1], runs[-2])
+        current[columns] = latest
+    return current, longest
+
+
+def _window_rate(done, applicable, days):
+    """Per-item completion rate over the trailing `days`, or None where nothing was scheduled"""
+    possible = applicable[-days:].sum(axis=0)
+    completed = done[-days:].sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rates = np.round(completed / possible * 100, 1)
+    return [None if n == 0 else float(r) for r, n in zip(rates, possible)]
+
+
+def compute(today=None):
+    today = today or date.today()
+    items, log_days, log_items = _load(today)
+    if not items:
+        return {'items': [], 'heatmap': [], 'rolling': {'dates': [], 'rates': []}}
+
+    item_ids = np.array([item.id for item in items], dtype=np.int64)
+    last_day = bitmaps.day_number(today)
+    first_day = min(int(log_days.min()) if len(log_days) else last_day, last_day - HEATMAP_DAYS + 1)
+    days = last_day - first_day + 1
+
+    # Scatter completed logs into the matrix; logs for deleted items are dropped
+    columns = np.searchsorted(item_ids, log_items)
+    known = (columns < len(item_ids)) & (item_ids[np.minimum(columns, len(item_ids) - 1)] == log_items)
+    weekend = bitmaps.weekends(np.arange(first_day, first_day + days))
+    item_types = np.array([item.routine_type for item in items])
+    applicable = np.stack([bitmaps.applies(routine_type, weekend) for routine_type in item_types], axis=1)
+    done = np.zeros((days, len(items)), dtype=bool)
+    done[log_days[known] - first_day, columns[known]] = True
+    done &= applicable
+
+    current, longest = _streaks(done, weekend, item_types)
+    rate_7d = _window_rate(done, applicable, 7)
+    rate_30d = _window_rate(done, applicable, 30)
+
+    # Heatmap: completed vs scheduled items per day for the last year
+    done_per_day = done.sum(axis=1)
+    possible_per_day = applicable.sum(axis=1)
+    start = today - timedelta(days=HEATMAP_DAYS - 1)
+    heatmap = [
+        {'date': (start + timedelta(days=i)).isoformat(), 'done': int(d), 'possible': int(p)}
+        for i, (d, p) in enumerate(zip(done_per_day[-HEATMAP_DAYS:], possible_per_day[-HEATMAP_DAYS:]))
+    ]
+
+    # Rolling 7-day rate across all items, from cumulative sums
+    done_cum = np.concatenate(([0], np.cumsum(done_per_day)))
+    possible_cum = np.concatenate(([0], np.cumsum(possible_per_day)))
+    window_done = done_cum[7:] - done_cum[:-7]
+    window_possible = possible_cum[7:] - possible_cum[:-7]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rolling = np.round(window_done / window_possible * 100, 1)[-ROLLING_DAYS:]
+    rolling_start = today - timedelta(days=len(rolling) - 1)
+
+    return {
+        'items': [
+            {
+                'id': item.id,
+                'name': item.name,
+                'routine_type': item.routine_type,
+                'current_streak': int(current[i]),
+                'longest_streak': int(longest[i]),
+                'rate_7d': rate_7d[i],
+                'rate_30d': rate_30d[i],
+            }
+            for i, item in enumerate(items)
+        ],
+        'heatmap': heatmap,
+        'rolling': {
+            'dates': [(rolling_start + timedelta(days=i)).isoformat() for i in range(len(rolling))],
+            'rates': [None if np.isnan(r) else float(r) for r in rolling],
+        },
+    }
@@ -0,0 +1,141 @@
+"""Concurrency stress test: several worker processes writing one SQLite file.
+
+Each worker is a separate process with its own app and connection pool,
+like a multi-worker WSGI server. Workers hammer a shared database with
+diary autosaves, habit toggles, photo uploads and dashboard reads. The
+report shows throughput and `database is locked` failures (503s) for each
+worker count, with the SQLite tuning from database.py on and (--baseline) off:
+
+    python stress.py --workers 1 2 4 8 --duration 10 --baseline
+"""
+import argparse
+import base64
+import io
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+from datetime import date, timedelta
+
+# Smallest valid PNG (1x1), so uploads go through the real thumbnail path
+PIXEL = base64.b64decode('iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mNkYAAAAAYAAjCB0C8AAAAASUVORK5CYII=')
+
+# (weight, name); the mix is write-heavy on purpose
+OPERATIONS = [(30, 'autosave'), (30, 'toggle'), (5, 'upload'), (35, 'dashboard')]
+
+
+def _use_database(database, tuned):
+    os.environ['DATABASE_URL'] = 'sqlite:///' + database
+    os.environ['SQLITE_TUNING'] = '1' if tuned else '0'
+
+
+def prepare(database, tuned):
+    """Create the shared database with a few months of history. Runs in a child process."""
+    _use_database(database, tuned)
+    from app import app
+    from generate_data import generate
+    with app.app_context():
+        generate(years=0.25, routines=10, photos_per_day=0)
+
+
+def run_worker(database, upload_folder, tuned, duration, seed, start_at, results):
+    """Issue requests until the deadline and report counts and latencies. Runs in a child process."""
+    _use_database(database, tuned)
+    from sqlalchemy.exc import OperationalError
+    from app import app
+    import database as db_config
+    import thumbnails
+    from models import RoutineItem
+
+    app.config['UPLOAD_FOLDER'] = upload_folder
+    app.config['UPLOAD_STAGING_FOLDER'] = os.path.join(os.path.dirname(upload_folder), 'upload-staging')
+    app.config['THUMBNAIL_WORKERS'] = 1
+    app.config['PROPAGATE_EXCEPTIONS'] = True # Surface other errors instead of a bare 500
+    app.config['LIVE_UPDATES'] = False # Workers would race for LIVE_PORT, and nothing listens here
+    with app.app_context():
+        item_ids = [item_id for (item_id,) in RoutineItem.query.with_entities(RoutineItem.id)]
+
+    rng = random.Random(seed)
+    weights, names = zip(*OPERATIONS)
+    client = app.test_client()
+    result = {'ok': 0, 'locked': 0, 'errors': 0, 'latencies': []}
+
+    time.sleep(max(0, start_at - time.time())) # Start every worker together
+    deadline = start_at + duration
+    while time.time() < deadline:
+        op = rng.choices(names, weights)[0]
+        day = (date.today() - timedelta(days=rng.randrange(30))).isoformat()
+        started = time.perf_counter()
+        try:
+            if op == 'autosave':
+                response = client.post('/diary/save', data={'date': day, 'content': f"Stress {rng.random()}"})
+            elif op == 'toggle':
+                response = client.post(f'/toggle_habit/{rng.choice(item_ids)}', json={'date': day})
+            elif op == 'upload':
+                response = client.post('/photo/upload', data={'date': day, 'photos': [(io.BytesIO(PIXEL), 'stress.png')]},
+                                       content_type='multipart/form-data')
+            else:
+                response = client.get(f'/?date={day}')
+            if response.status_code == 503:
+                result['locked'] += 1 # Still locked after retry_on_lock gave up
+            else:
+                result['ok' if response.status_code < 400 else 'errors'] += 1
+        except OperationalError as e:
+            result['locked' if db_config.is_lock_error(e) else 'errors'] += 1
+        result['latencies'].append((time.perf_counter() - started) * 1000)
+
+    thumbnails.shutdown()
+    results.put(result)
+
+
+def run(workers, tuned, duration, workdir):
+    context = multiprocessing.get_context('spawn')
+    database = os.path.join(workdir, f"stress_{workers}_{'tuned' if tuned else 'baseline'}.db")
+    upload_folder = os.path.join(workdir, 'uploads')
+    os.makedirs(upload_folder, exist_ok=True)
+    with context.Pool(1) as pool:
+        pool.apply(prepare, (database, tuned))
+
+    # Plain processes rather than a pool: workers start their own thumbnail pools, which daemons can't
+    queue = context.Queue()
+    start_at = time.time() + 3 # Time for every worker to import the app
+    processes = [context.Process(target=run_worker, args=(database, upload_folder, tuned, duration, seed, start_at, queue))
+                 for seed in range(workers)]
+    for process in processes:
+        process.start()
+    results = [queue.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    latencies = sorted(ms for r in results for ms in r['latencies'])
+    total = sum(r['ok'] + r['locked'] + r['errors'] for r in results)
+    return {
+        'workers': workers,
+        'tuned': tuned,
+        'requests': total,
+        'per_second': round(sum(r['ok'] for r in results) / duration, 1),
+        'locked': sum(r['locked'] for r in results),
+        'errors': sum(r['errors'] for r in results),
+        'p95_ms': round(latencies[int(len(latencies) * 0.95)], 1) if latencies else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8], help="Worker process counts to try")
+    parser.add_argument('--duration', type=float, default=10, help="Seconds per run")
+    parser.add_argument('--baseline', action='store_true', help="Also run with SQLite tuning off, for comparison")
+    args = parser.parse_args()
+
+    print(f"{'mode':<10}{'workers':>8}{'requests':>10}{'ok/s':>9}{'locked':>8}{'errors':>8}{'p95 ms':>9}")
+    with tempfile.TemporaryDirectory() as workdir:
+        for tuned in ([False] if args.baseline else []) + [True]:
+            for workers in args.workers:
+                r = run(workers, tuned, args.duration, workdir)
+                print(f"{'tuned' if tuned else 'baseline':<10}{r['workers']:>8}{r['requests']:>10}{r['per_second']:>9}"
+                      f"{r['locked']:>8}{r['errors']:>8}{r['p95_ms']:>9}")
+
+
+if __name__ == "__main__":
+    main()
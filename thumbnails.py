@@ -0,0 +1,141 @@
+"""Resized derivatives for uploaded diary photos.
+
+Uploads are stored untouched; a process pool then renders smaller JPEG and
+WebP copies in the background so the gallery and timeline never have to
+ship full-size phone photos. Pillow is optional: without it no variants are
+built and the templates fall back to the original file.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from models import db, DiaryImage, DiaryImageVariant
+import shards
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# kind -> longest edge in pixels
+SIZES = {
+    'thumb': 320,   # Gallery/timeline grid tiles
+    'modal': 1280,  # Gallery lightbox
+}
+FORMATS = {
+    'jpeg': ('jpg', {'quality': 82, 'optimize': True, 'progressive': True}),
+    'webp': ('webp', {'quality': 80, 'method': 4}),
+}
+
+_executor = None
+
+
+def variant_filename(image_path, kind, fmt):
+    stem = os.path.splitext(image_path)[0]
+    return f"{stem}.{kind}.{FORMATS[fmt][0]}"
+
+
+def build_variants(upload_folder, image_path):
+    """Render every size/format of one upload. Runs in a worker process.
+
+    Returns a list of dicts describing the files that were written.
+    """
+    built = []
+    with Image.open(os.path.join(upload_folder, image_path)) as source:
+        source = ImageOps.exif_transpose(source)
+        if source.mode not in ('RGB', 'L'):
+            source = source.convert('RGB')
+
+        for kind, edge in SIZES.items():
+            resized = source.copy()
+            resized.thumbnail((edge, edge), Image.LANCZOS)
+            for fmt, (ext, options) in FORMATS.items():
+                filename = variant_filename(image_path, kind, fmt)
+                resized.save(os.path.join(upload_folder, filename), fmt.upper(), **options)
+                built.append({
+                    'kind': kind,
+                    'format': fmt,
+                    'width': resized.width,
+                    'height': resized.height,
+                    'image_path': filename,
+                })
+    return built
+
+
+def _get_executor(app):
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=app.config.get('THUMBNAIL_WORKERS', 2))
+    return _executor
+
+
+def _store_variants(app, shard, upload_folder, image_id, image_path, future):
+    try:
+        built = future.result()
+    except Exception as exc:
+        app.logger.warning("Could not build variants for image %s: %s", image_id, exc)
+        return
+
+    with shards.app_context(app, shard):
+        # The photo may have been deleted while its variants were rendering
+        if db.session.get(DiaryImage, image_id) is None:
+            # Identical uploads share files, so only remove them if no other photo uses them
+            if DiaryImage.query.filter_by(image_path=image_path).first() is None:
+                for variant in built:
+                    remove_file(upload_folder, variant['image_path'])
+            return
+        db.session.add_all(DiaryImageVariant(diary_image_id=image_id, **variant) for variant in built)
+        db.session.commit()
+
+
+def schedule(app, images):
+    """Queue variant rendering for freshly committed DiaryImage rows.
+
+    Returns immediately; results are recorded from the pool's callback.
+    """
+    if Image is None:
+        return []
+    shard, upload_folder = shards.current(), shards.upload_folder()
+    futures = []
+    for image in images:
+        if _share_variants(image):
+            continue
+        future = _get_executor(app).submit(build_variants, upload_folder, image.image_path)
+        future.add_done_callback(
+            lambda f, image_id=image.id, path=image.image_path: _store_variants(app, shard, upload_folder, image_id, path, f))
+        futures.append(future)
+    return futures
+
+
+def _share_variants(image):
+    """Point a re-uploaded photo at the variants already rendered for its file"""
+    existing = (
+        DiaryImageVariant.query.join(DiaryImage)
+        .filter(DiaryImage.image_path == image.image_path, DiaryImage.id != image.id)
+        .all()
+    )
+    shared = {}
+    for variant in existing:
+        shared.setdefault((variant.kind, variant.format), variant)
+    if not shared:
+        return False
+    db.session.add_all(
+        DiaryImageVariant(diary_image_id=image.id, kind=v.kind, format=v.format,
+                          width=v.width, height=v.height, image_path=v.image_path)
+        for v in shared.values()
+    )
+    db.session.commit()
+    return True
+
+
+def shutdown():
+    """Wait for queued renders to finish and their variants to be stored"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+
+def remove_file(upload_folder, filename):
+    try:
+        os.remove(os.path.join(upload_folder, filename))
+    except OSError:
+        pass # File might not exist
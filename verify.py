@@ -3,6 +3,9 @@ import sys
 from app import app, db
 from models import RoutineItem
 
+# Pages every release must serve; benchmark.py times the same list
+ROUTES = ['/', '/settings', '/timetable', '/diary', '/gallery', '/timeline', '/analytics', '/api/streaks', '/api/scores']
+
 def verify():
     print("Verifying setup...")
     
@@ -22,8 +25,7 @@ def verify():
             
         # 3. Check Routes
         client = app.test_client()
-        routes = ['/', '/settings', '/timetable', '/diary', '/gallery', '/timeline', '/analytics']
-        for route in routes:
+        for route in ROUTES:
             response = client.get(route)
             print(f"Route {route} Status: {response.status_code}")
             if response.status_code != 200:
@@ -0,0 +1,126 @@
+"""Per-table data versions for conditional GETs of read-heavy pages.
+
+`data_versions` holds a counter and a last-modified time for each table.
+SQLite triggers bump them on every insert, update and delete, so every
+write path is covered: routes, rollups, thumbnail callbacks and imports.
+Because the counters live in the database, all worker processes agree on
+them.
+
+Views wrapped in `conditional(...)` read the counters for their tables in
+one small query. The ETag and Last-Modified headers come from those
+counters, and a request with a matching ETag gets a 304 before the view
+runs. If-Modified-Since alone never does: the times only have whole
+seconds, and they don't cover the user, the URL or the templates. Fresh
+responses can also be kept in a small page cache keyed by the same ETag.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from datetime import date, datetime, timezone
+from functools import wraps
+from flask import current_app, request, make_response
+from sqlalchemy import bindparam, text
+from models import db
+import shards
+
+TABLES = ['routine_items', 'tracker_logs', 'diary_entries', 'diary_images', 'diary_image_variants',
+          'reminders', 'user_settings', 'routine_rollups', 'diary_rollups', 'completion_bitmaps']
+
+_BUMP = "UPDATE data_versions SET version = version + 1, updated_at = CAST(strftime('%s', 'now') AS INTEGER) WHERE name = '{table}'"
+
+_CURRENT = text(
+    "SELECT name, version, updated_at FROM data_versions WHERE name IN :names"
+).bindparams(bindparam('names', expanding=True))
+
+_cache = OrderedDict() # (path, etag) -> (body, status, headers)
+_cache_lock = threading.Lock()
+_salt = None
+
+
+def install(conn):
+    """Create the counters table and the triggers that keep it current"""
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS data_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0,
+            updated_at INTEGER NOT NULL DEFAULT 0
+        )
+    """))
+    for table in TABLES:
+        conn.execute(text(
+            "INSERT OR IGNORE INTO data_versions (name, updated_at) VALUES (:name, CAST(strftime('%s', 'now') AS INTEGER))"
+        ), {'name': table})
+        for event, suffix in (('INSERT', 'ai'), ('UPDATE', 'au'), ('DELETE', 'ad')):
+            conn.execute(text(
+                f"CREATE TRIGGER IF NOT EXISTS {table}_version_{suffix} AFTER {event} ON {table} "
+                f"BEGIN {_BUMP.format(table=table)}; END"
+            ))
+
+
+def current(tables):
+    """(versions, last modified) for the given tables"""
+    rows = db.session.execute(_CURRENT, {'names': list(tables)}).all()
+    versions = ','.join(f'{name}:{version}' for name, version, _ in sorted(rows))
+    updated_at = max((updated for _, _, updated in rows), default=0)
+    return versions, datetime.fromtimestamp(updated_at, timezone.utc)
+
+
+def _templates_salt():
+    """Changes whenever a template does, so a deploy doesn't 304 into stale markup"""
+    global _salt
+    if _salt is None:
+        folder = os.path.join(current_app.root_path, current_app.template_folder)
+        mtimes = [os.stat(os.path.join(folder, name)).st_mtime_ns for name in sorted(os.listdir(folder))]
+        _salt = str(max(mtimes, default=0))
+    return _salt
+
+
+def conditional(*tables, daily=False):
+    """Answer repeat GETs with 304 while `tables` are unchanged.
+
+    `daily` marks pages that also depend on today's date, such as "the last
+    7 days", so their ETag rolls over at midnight as well.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            versions, last_modified = current(tables)
+            key = '|'.join([_templates_salt(), str(shards.current()), request.full_path, versions,
+                            date.today().isoformat() if daily else ''])
+            etag = hashlib.sha1(key.encode()).hexdigest()[:20]
+
+            if request.if_none_match.contains_weak(etag):
+                response = make_response('', 304)
+            else:
+                response = _cached(request.full_path, etag) or make_response(view(*args, **kwargs))
+                if response.status_code == 200:
+                    _store(request.full_path, etag, response)
+
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            response.cache_control.no_cache = True # Always revalidate; the 304 is what makes it cheap
+            return response
+        return wrapper
+    return decorator
+
+
+def _cached(path, etag):
+    with _cache_lock:
+        entry = _cache.get((path, etag))
+        if entry is None:
+            return None
+        _cache.move_to_end((path, etag))
+    body, status, headers = entry
+    return current_app.response_class(body, status, headers)
+
+
+def _store(path, etag, response):
+    size = current_app.config.get('PAGE_CACHE_SIZE', 0)
+    if not size or response.direct_passthrough:
+        return
+    with _cache_lock:
+        _cache[(path, etag)] = (response.get_data(), response.status_code, list(response.headers))
+        _cache.move_to_end((path, etag))
+        while len(_cache) > size:
+            _cache.popitem(last=False)